@@ -1,11 +1,19 @@
-from flask import Flask, render_template, request, send_file, jsonify, abort
-import os, zipfile, pandas as pd, razorpay, uuid, json, re, traceback, shutil
-from tools.invoice_tool import generate_invoices
-from tools.csv_cleaner import clean_csv
-from tools.pdf_to_excel import pdf_to_excel
-from tools.pdf_processor import merge_pdfs, split_pdf
+from flask import Flask, render_template, request, send_file, jsonify, abort, g
+import os, io, zipfile, pandas as pd, razorpay, uuid, json, re, traceback, shutil
+import sqlite3, threading, time, multiprocessing, mimetypes, resource
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tools.invoice_tool import (iter_invoices, generate_combined_invoice_pdf, check_combined_rows,
+                                INVOICE_WORKERS)
+from tools.csv_cleaner import clean_csv, read_header, CSV_WORKERS
+from tools.clean_pipeline import Pipeline, parse_steps
+from tools.table_output import OUTPUT_FORMATS
+from tools.pdf_to_excel import pdf_to_excel, PDF_WORKERS
+from tools.pdf_processor import merge_pdfs, iter_split_pdf
 from tools.excel_formula_engine import generate_formula
+from tools import metrics
 import hmac, hashlib
+from urllib.parse import quote as url_quote
 from datetime import date, datetime
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,11 +25,22 @@ app = Flask(
 )
 app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024
 
+# Not in the stdlib table yet; used for the Content-Type of cleaner downloads
+mimetypes.add_type("application/vnd.apache.parquet", ".parquet")
+
+# guess_type() reports .csv.gz as text/csv with gzip *encoding*; downloads
+# are the compressed file itself
+COMPRESSED_MIMETYPES = {
+    ".gz": "application/gzip",
+    ".zst": "application/zstd",
+}
+
 UPLOAD_FOLDER = "uploads"
 OUTPUT_FOLDER = "outputs"
-JOB_DB = "jobs.json"
+JOB_DB = "jobs.db"
+LEGACY_JOB_DB = "jobs.json"
 
-FREE_DB = "free_usage.json"
+LEGACY_FREE_DB = "free_usage.json"
 FREE_LIMIT = 2
 FREE_SIZE_MB = 4
 
@@ -42,28 +61,197 @@ def smart_rename(tool_prefix, ext):
     return f"{tool_prefix}_{timestamp}_{unique_id}{ext}"
 
 # ---------------- JOB STORE ----------------
+# Jobs live in an embedded SQLite database (WAL mode) so every request does a
+# point lookup / single-row write instead of rewriting the whole store, and
+# concurrent gunicorn workers don't clobber each other.
+
+_db_local = threading.local()
+
+def get_db():
+    """Per-thread, per-process SQLite connection (connections must not cross a fork)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(JOB_DB, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+def init_job_store():
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                filename TEXT,
+                paid INTEGER NOT NULL DEFAULT 0,
+                free INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )
+        """)
+    add_missing_columns("jobs", {
+        "status": "TEXT NOT NULL DEFAULT 'ready'",
+        "progress": "INTEGER NOT NULL DEFAULT 100",
+        "error": "TEXT",
+        "expires_at": "REAL",
+        "size": "INTEGER NOT NULL DEFAULT 0",
+    })
+    import_legacy_jobs()
+
+def add_missing_columns(table, columns):
+    """Adds columns introduced after a database was first created."""
+    conn = get_db()
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    with conn:
+        for name, decl in columns.items():
+            if name not in existing:
+                try:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+                except sqlite3.OperationalError:
+                    # Another worker added it first
+                    pass
+
+def import_legacy_jobs():
+    """One-time import of the old jobs.json store. Safe to race between workers."""
+    try:
+        with open(LEGACY_JOB_DB) as f:
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    now = time.time()
+    rows = [
+        (job_id, job["file"], job.get("filename", os.path.basename(job["file"])),
+         int(bool(job.get("paid"))), int(bool(job.get("free"))), now)
+        for job_id, job in legacy.items()
+    ]
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO jobs (id, file, filename, paid, free, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
 
-def load_jobs():
-    if not os.path.exists(JOB_DB):
-        return {}
-    with open(JOB_DB) as f:
-        return json.load(f)
-
-def save_jobs(data):
-    with open(JOB_DB, "w") as f:
-        json.dump(data, f, indent=2)
+    try:
+        os.replace(LEGACY_JOB_DB, LEGACY_JOB_DB + ".imported")
+    except OSError:
+        pass
+
+def _job_from_row(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["paid"] = bool(job["paid"])
+    job["free"] = bool(job["free"])
+    return job
+
+def create_job(file, filename, free, status="ready"):
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    progress = 100 if status == "ready" else 0
+    size = os.path.getsize(file) if status == "ready" else 0
+    conn = get_db()
+    with metrics.stage("jobs", "db_write"), conn:
+        conn.execute(
+            "INSERT INTO jobs (id, file, filename, paid, free, created_at, status, progress, expires_at, size) "
+            "VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?, ?)",
+            (job_id, file, filename, int(bool(free)), now, status, progress, now + JOB_TTL, size)
+        )
+    return job_id
+
+def get_job(job_id):
+    with metrics.stage("jobs", "db_read"):
+        row = get_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_from_row(row)
+
+def set_job_status(job_id, status, progress=None, error=None):
+    conn = get_db()
+    with metrics.stage("jobs", "db_write"), conn:
+        if progress is None:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ? WHERE id = ?",
+                (status, error, job_id)
+            )
+        else:
+            conn.execute(
+                "UPDATE jobs SET status = ?, progress = ?, error = ? WHERE id = ?",
+                (status, progress, error, job_id)
+            )
+
+def set_job_size(job_id, size):
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE jobs SET size = ? WHERE id = ?", (size, job_id))
+
+def mark_job_paid(job_id):
+    conn = get_db()
+    with conn:
+        cur = conn.execute(
+            "UPDATE jobs SET paid = 1, expires_at = MAX(COALESCE(expires_at, 0), ?) "
+            "WHERE id = ? AND status != 'expired'",
+            (time.time() + PAID_JOB_TTL, job_id)
+        )
+    return cur.rowcount > 0
+
+init_job_store()
 
 # ---------------- FREE USAGE ----------------
+# One row per (day, visitor) in the job database. Claiming a free use is a
+# single atomic upsert, and rows from previous days are purged on rollover.
+
+_free_purged_day = None
+
+def init_free_usage():
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS free_usage (
+                day TEXT NOT NULL,
+                visitor_id TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, visitor_id)
+            ) WITHOUT ROWID
+        """)
+    import_legacy_free_usage()
+
+def import_legacy_free_usage():
+    """Carry today's counts over from the old free_usage.json, once."""
+    try:
+        with open(LEGACY_FREE_DB) as f:
+            legacy = json.load(f)
+    except (OSError, ValueError):
+        return
 
-def load_free_usage():
-    if not os.path.exists(FREE_DB):
-        return {}
-    with open(FREE_DB) as f:
-        return json.load(f)
+    today = str(date.today())
+    rows = [
+        (today, visitor_id, int(entry["count"]))
+        for visitor_id, entry in legacy.items()
+        if entry.get("date") == today
+    ]
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO free_usage (day, visitor_id, count) VALUES (?, ?, ?)",
+            rows
+        )
 
-def save_free_usage(data):
-    with open(FREE_DB, "w") as f:
-        json.dump(data, f, indent=2)
+    try:
+        os.replace(LEGACY_FREE_DB, LEGACY_FREE_DB + ".imported")
+    except OSError:
+        pass
+
+def purge_old_free_usage(today):
+    global _free_purged_day
+    if _free_purged_day == today:
+        return
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM free_usage WHERE day < ?", (today,))
+    _free_purged_day = today
 
 def get_visitor_id(req):
     fp = req.headers.get("X-Visitor-ID")
@@ -71,33 +259,656 @@ def get_visitor_id(req):
         return fp
     return req.remote_addr
 
-def can_use_free(visitor_id, file_size_bytes):
-    today = str(date.today())
+def claim_free_use(visitor_id, file_size_bytes):
+    """
+    Atomically checks the visitor's daily quota and, if there is room,
+    counts this request against it. Returns True if the request is free.
+    """
     size_mb = file_size_bytes / (1024 * 1024)
-
     if size_mb > FREE_SIZE_MB:
         return False
 
-    data = load_free_usage()
-
-    if visitor_id not in data or data[visitor_id]["date"] != today:
-        return True
-
-    if data[visitor_id]["count"] < FREE_LIMIT:
-        return True
-
-    return False
-
-def mark_free_used(visitor_id):
     today = str(date.today())
-    data = load_free_usage()
-
-    if visitor_id not in data or data[visitor_id]["date"] != today:
-        data[visitor_id] = {"date": today, "count": 1}
+    purge_old_free_usage(today)
+
+    conn = get_db()
+    with conn:
+        cur = conn.execute("""
+            INSERT INTO free_usage (day, visitor_id, count) VALUES (?, ?, 1)
+            ON CONFLICT (day, visitor_id) DO UPDATE SET count = count + 1
+            WHERE count < ?
+        """, (today, visitor_id, FREE_LIMIT))
+    return cur.rowcount > 0
+
+def release_free_use(visitor_id):
+    """Gives a claimed free use back, e.g. when processing failed."""
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "UPDATE free_usage SET count = count - 1 WHERE day = ? AND visitor_id = ? AND count > 0",
+            (str(date.today()), visitor_id)
+        )
+
+init_free_usage()
+
+# ---------------- UPLOADS ----------------
+# Small uploads are handed to the tools as in-memory bytes; only uploads over
+# SPOOL_MAX_MEMORY are written to UPLOAD_FOLDER. Either form can be passed
+# straight to the tools (pandas, pypdf and pdfplumber take paths or streams).
+
+SPOOL_MAX_MEMORY = int(os.environ.get("SPOOL_MAX_MEMORY", 2 * 1024 * 1024))
+
+def spool_upload(uploaded_file):
+    """Returns (bytes or saved path, size in bytes) for a werkzeug FileStorage."""
+    with metrics.stage("upload", "spool"):
+        return _spool(uploaded_file)
+
+def _spool(uploaded_file):
+    stream = uploaded_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+
+    if size <= SPOOL_MAX_MEMORY:
+        return stream.read(), size
+
+    path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{os.path.basename(uploaded_file.filename)}")
+    uploaded_file.save(path)
+    return path, size
+
+def open_input(upload):
+    """Turns a spooled upload into something the tools can read."""
+    if isinstance(upload, bytes):
+        return io.BytesIO(upload)
+    return upload
+
+def input_size(upload):
+    if isinstance(upload, bytes):
+        return len(upload)
+    return os.path.getsize(upload)
+
+def discard_inputs(inputs):
+    for upload in inputs:
+        if isinstance(upload, str) and os.path.exists(upload):
+            os.remove(upload)
+
+# ---------------- ZIP ARCHIVES ----------------
+# Multi-file tools yield (name, bytes) pairs that go straight into the archive,
+# so nothing is staged on disk. PDFs barely compress with DEFLATE, so the
+# default level 0 stores them; set ZIP_COMPRESS_LEVEL=1..9 to deflate.
+
+ZIP_COMPRESS_LEVEL = int(os.environ.get("ZIP_COMPRESS_LEVEL", 0))
+
+def write_zip(entries, zip_path):
+    if ZIP_COMPRESS_LEVEL > 0:
+        options = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": ZIP_COMPRESS_LEVEL}
     else:
-        data[visitor_id]["count"] += 1
-
-    save_free_usage(data)
+        options = {"compression": zipfile.ZIP_STORED}
+
+    with zipfile.ZipFile(zip_path, "w", **options) as zipf:
+        for name, data in entries:
+            with metrics.stage("zip", "write_entry"):
+                zipf.writestr(name, data)
+    return zip_path
+
+# ---------------- WORKER POOL ----------------
+# Uploads are spooled, a "queued" job is recorded, and the tool runs in a bounded
+# process pool. Workers report progress through the job store, which is what
+# /check-status reads.
+
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 2))
+
+# Tools with a parallel mode start their own pool per job, inside a pool
+# worker. Each job gets at most this many processes, so the web processes
+# (WEB_CONCURRENCY, as gunicorn reads it) times WORKER_PROCESSES jobs share
+# the cores instead of each asking for all of them.
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+JOB_WORKERS = int(os.environ.get(
+    "JOB_WORKERS", max(1, (os.cpu_count() or 1) // (WEB_CONCURRENCY * WORKER_PROCESSES))
+))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES)
+            _pool_pid = os.getpid()
+        return _pool
+
+def reset_pool(broken):
+    """Drops `broken` so the next get_pool() starts a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+
+def submit_job(job_id, runner, inputs, output_path, visitor_id=None, cache_key=None, **params):
+    args = (run_job, job_id, runner, inputs, output_path, visitor_id, cache_key, params)
+    pool = get_pool()
+    try:
+        future = pool.submit(*args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM); start a fresh pool and retry once
+        reset_pool(pool)
+        pool = get_pool()
+        future = pool.submit(*args)
+    future.add_done_callback(lambda f: job_lost(f, pool, job_id, runner, inputs, visitor_id))
+
+def job_lost(future, pool, job_id, runner, inputs, visitor_id):
+    """
+    Done callback of every job. run_job() records its own outcome, so this
+    only acts when it never got to: the worker died mid-job (BrokenProcessPool)
+    or the pool shut down before the job started.
+    """
+    if not future.cancelled():
+        error = future.exception()
+        if error is None:
+            return
+        if isinstance(error, BrokenProcessPool):
+            reset_pool(pool)
+
+    job = get_job(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        return
+    set_job_status(job_id, "failed", error=JOB_ERRORS.get(runner.__name__, "Processing failed."))
+    if visitor_id:
+        release_free_use(visitor_id)
+    discard_inputs(inputs)
+    metrics.inc("jobs_total", tool=runner.__name__.replace("run_", "", 1), status="lost")
+
+def job_progress(job_id):
+    """Progress callback for the tools: writes percent done when it changes."""
+    last = [-1]
+
+    def report(done, total):
+        percent = int(done * 100 / total) if total else 0
+        percent = min(percent, 99)
+        if percent != last[0]:
+            last[0] = percent
+            set_job_status(job_id, "running", percent)
+
+    return report
+
+def run_job(job_id, runner, inputs, output_path, visitor_id, cache_key, params):
+    """Executes inside a pool worker."""
+    tool = runner.__name__.replace("run_", "", 1)
+    started = time.perf_counter()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    status = "failed"
+
+    set_job_status(job_id, "running", 0)
+    try:
+        # Runners return False when the output is only a stand-in (an error
+        # sheet, say) that a retry could improve on, so it isn't cached
+        complete = runner(inputs, output_path, job_progress(job_id), **params)
+        output_size = os.path.getsize(output_path)
+        set_job_size(job_id, output_size)
+        set_job_status(job_id, "ready", 100)
+        status = "ready"
+        metrics.inc("bytes_processed_total", output_size, tool=tool, direction="out")
+        if cache_key and complete is not False:
+            cache_store(cache_key, output_path)
+    except Exception as e:
+        traceback.print_exc()
+        set_job_status(job_id, "failed", error=job_error(runner, e))
+        if visitor_id:
+            release_free_use(visitor_id)
+    finally:
+        discard_inputs(inputs)
+
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+        metrics.observe("job_duration_seconds", time.perf_counter() - started, tool=tool)
+        metrics.observe("job_cpu_seconds", cpu, tool=tool)
+        metrics.inc("jobs_total", tool=tool, status=status)
+        flush_metrics()
+
+def run_invoice(inputs, output_path, progress, workers=1, combined=False):
+    failures = []
+    if combined:
+        generate_combined_invoice_pdf(open_input(inputs[0]), output_path, progress=progress,
+                                      workers=workers, failures=failures)
+        # Rows that failed may render on a retry: don't cache a partial result
+        return not failures
+
+    entries = iter_invoices(open_input(inputs[0]), progress=progress, workers=workers, failures=failures)
+
+    def with_failure_report():
+        yield from entries
+        # Rows that couldn't be rendered are listed in the archive instead of failing the job
+        if failures:
+            report = "\n".join(f"{name}: {error}" for name, error in failures)
+            yield "failed_invoices.txt", report + "\n"
+
+    write_zip(with_failure_report(), output_path)
+    return not failures
+
+def run_csv_cleaner(inputs, output_path, progress, exact_dedup=False, output_format="csv", workers=1,
+                    steps=None):
+    # Private work dir so concurrent jobs don't overwrite each other's cleaned file
+    work_dir = os.path.join(OUTPUT_FOLDER, "csv_cleaner", str(uuid.uuid4()))
+    cleaned_file_path = clean_csv(open_input(inputs[0]), work_dir, progress=progress,
+                                  exact_dedup=exact_dedup, output_format=output_format,
+                                  workers=workers, steps=steps)
+    shutil.move(cleaned_file_path, output_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_pdf_to_excel(inputs, output_path, progress, workers=1):
+    work_dir = os.path.join(OUTPUT_FOLDER, "pdf_to_excel", str(uuid.uuid4()))
+    failures = []
+    excel_file = pdf_to_excel(open_input(inputs[0]), work_dir, progress=progress, workers=workers,
+                              failures=failures)
+    shutil.move(excel_file, output_path)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    # An error sheet or pages lost to OCR failures may be transient: don't cache them
+    return not failures
+
+def run_pdf_merge(inputs, output_path, progress):
+    merge_pdfs([open_input(upload) for upload in inputs], output_path, progress=progress)
+
+def run_pdf_split(inputs, output_path, progress):
+    write_zip(iter_split_pdf(open_input(inputs[0]), progress=progress), output_path)
+
+# ValueErrors raised by the tools are written for the user (bad rows, size
+# limits), except the ones pandas and the codecs raise about unreadable input
+UNREADABLE_INPUT_ERRORS = (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeError)
+
+def job_error(runner, error):
+    """What /check-status shows for a job that raised `error`."""
+    if isinstance(error, ValueError) and not isinstance(error, UNREADABLE_INPUT_ERRORS):
+        return str(error)
+    return JOB_ERRORS.get(runner.__name__, "Processing failed.")
+
+JOB_ERRORS = {
+    "run_invoice": "Failed to process invoice CSV. Ensure format is correct.",
+    "run_csv_cleaner": "Could not clean CSV. File might be empty or corrupted.",
+    "run_pdf_to_excel": "PDF conversion failed. File might be password protected or corrupted.",
+    "run_pdf_merge": "Merge failed. Some files might be corrupted.",
+    "run_pdf_split": "Split failed. File might be corrupted.",
+}
+
+# ---------------- RESULT CACHE ----------------
+# Finished outputs are indexed by a hash of (tool, params, upload bytes). A
+# repeated upload gets a new job pointing at the existing output file instead
+# of rerunning OCR / wkhtmltopdf. Entries expire by age and the oldest-used
+# are dropped once the cached outputs exceed CACHE_MAX_BYTES.
+
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 24 * 60 * 60))
+
+def init_result_cache():
+    conn = get_db()
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                file TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_hit REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_file ON jobs (file)")
+
+def bump_counter(name, amount=1):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+def upload_digest(upload):
+    if isinstance(upload, bytes):
+        return hashlib.sha256(upload).hexdigest()
+
+    h = hashlib.sha256()
+    with open(upload, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(tool, inputs, params):
+    h = hashlib.sha256()
+    h.update(tool.encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    for upload in inputs:
+        h.update(upload_digest(upload).encode())
+    return h.hexdigest()
+
+def cache_lookup(key):
+    conn = get_db()
+    row = conn.execute("SELECT file, created_at FROM result_cache WHERE key = ?", (key,)).fetchone()
+    now = time.time()
+
+    if row is None or now - row["created_at"] > CACHE_MAX_AGE or not os.path.exists(row["file"]):
+        if row is not None:
+            with conn:
+                conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+        bump_counter("cache_misses")
+        return None
+
+    with conn:
+        conn.execute("UPDATE result_cache SET last_hit = ? WHERE key = ?", (now, key))
+    bump_counter("cache_hits")
+    return row["file"]
+
+def cache_store(key, output_path):
+    now = time.time()
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO result_cache (key, file, size, created_at, last_hit) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, output_path, os.path.getsize(output_path), now, now)
+        )
+    evict_cache()
+
+def evict_cache():
+    conn = get_db()
+    now = time.time()
+    expired = conn.execute(
+        "SELECT key, file FROM result_cache WHERE created_at < ?", (now - CACHE_MAX_AGE,)
+    ).fetchall()
+
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM result_cache").fetchone()[0]
+    over_quota = []
+    if total > CACHE_MAX_BYTES:
+        for row in conn.execute("SELECT key, file, size FROM result_cache ORDER BY last_hit"):
+            if total <= CACHE_MAX_BYTES:
+                break
+            over_quota.append(row)
+            total -= row["size"]
+
+    for row in expired + over_quota:
+        drop_cache_entry(row["key"], row["file"])
+    if expired or over_quota:
+        bump_counter("cache_evictions", len(expired) + len(over_quota))
+
+def drop_cache_entry(key, file):
+    """Removes a cache entry; the file goes too unless a job still points at it."""
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+    if not file_in_use(file):
+        if os.path.exists(file): os.remove(file)
+
+def cache_stats():
+    conn = get_db()
+    entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache").fetchone()
+    counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    return {
+        "entries": entries,
+        "bytes": size,
+        "hits": counters.get("cache_hits", 0),
+        "misses": counters.get("cache_misses", 0),
+        "evictions": counters.get("cache_evictions", 0),
+    }
+
+def start_job(tool, runner, inputs, output_path, output_filename, is_free, visitor_id, **params):
+    """
+    Creates the job for an upload: served from the result cache when the same
+    input was processed before, otherwise queued on the worker pool.
+    Returns (job_id, status).
+    """
+    metrics.inc("bytes_processed_total", sum(input_size(upload) for upload in inputs),
+                tool=tool, direction="in")
+
+    with metrics.stage(tool, "cache_lookup"):
+        key = cache_key(tool, inputs, params)
+        cached_file = cache_lookup(key)
+    if cached_file:
+        discard_inputs(inputs)
+        return create_job(cached_file, output_filename, is_free), "ready"
+
+    job_id = create_job(output_path, output_filename, is_free, status="queued")
+    submit_job(job_id, runner, inputs, output_path, visitor_id if is_free else None,
+               cache_key=key, **params)
+    return job_id, "queued"
+
+init_result_cache()
+
+# ---------------- RETENTION ----------------
+# Every job gets an expiry (longer once paid). A background janitor fails jobs
+# stuck past JOB_TIMEOUT, deletes expired outputs, keeps OUTPUT_FOLDER under
+# OUTPUT_QUOTA_BYTES by expiring the oldest unpaid jobs first, and clears
+# stale work files. Expired jobs are kept as tombstones for
+# EXPIRED_RECORD_TTL so their links answer 410, then removed.
+
+JOB_TTL = int(os.environ.get("JOB_TTL", 24 * 60 * 60))
+PAID_JOB_TTL = int(os.environ.get("PAID_JOB_TTL", 7 * 24 * 60 * 60))
+EXPIRED_RECORD_TTL = int(os.environ.get("EXPIRED_RECORD_TTL", 7 * 24 * 60 * 60))
+OUTPUT_QUOTA_BYTES = int(os.environ.get("OUTPUT_QUOTA_BYTES", 5 * 1024 * 1024 * 1024))
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", 5 * 60))
+
+# Jobs still queued or running this long after upload are failed: their
+# worker is gone (a web process restarted with jobs waiting in its pool, or a
+# crash the done callback never saw).
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 2 * 60 * 60))
+
+# Folders that only hold scratch files for in-flight jobs
+WORK_FOLDERS = [
+    UPLOAD_FOLDER,
+    os.path.join(OUTPUT_FOLDER, "csv_cleaner"),
+    os.path.join(OUTPUT_FOLDER, "pdf_to_excel"),
+]
+
+def init_retention():
+    conn = get_db()
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs (expires_at)")
+        conn.execute(
+            "UPDATE jobs SET expires_at = created_at + ? WHERE expires_at IS NULL",
+            (JOB_TTL,)
+        )
+
+def file_in_use(file):
+    row = get_db().execute(
+        "SELECT 1 FROM jobs WHERE file = ? AND status != 'expired' LIMIT 1", (file,)
+    ).fetchone()
+    return row is not None
+
+def expire_job(job_id, file):
+    """Marks a job expired and deletes its output once no live job shares it."""
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE jobs SET status = 'expired' WHERE id = ?", (job_id,))
+
+    if file_in_use(file):
+        return 0
+
+    with conn:
+        conn.execute("DELETE FROM result_cache WHERE file = ?", (file,))
+    if os.path.exists(file):
+        freed = os.path.getsize(file)
+        os.remove(file)
+        return freed
+    return 0
+
+def remove_stale_entries(folder, cutoff, keep_referenced=False):
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            path = os.path.join(folder, entry.name)
+            if keep_referenced and file_in_use(path):
+                continue
+            if entry.is_dir():
+                if path not in WORK_FOLDERS:
+                    shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+def fail_stale_jobs(now):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ? "
+            "WHERE status IN ('queued', 'running') AND created_at < ?",
+            ("Processing was interrupted. Please upload the file again.", now - JOB_TIMEOUT)
+        )
+
+def sweep_outputs():
+    conn = get_db()
+    now = time.time()
+
+    # 0. Jobs whose worker is gone
+    fail_stale_jobs(now)
+
+    # 1. Expired jobs (index on expires_at)
+    expired = conn.execute(
+        "SELECT id, file FROM jobs WHERE expires_at < ? AND status != 'expired'", (now,)
+    ).fetchall()
+    for row in expired:
+        expire_job(row["id"], row["file"])
+
+    # 2. Disk quota: oldest unpaid jobs go first
+    total = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM "
+        "(SELECT MAX(size) AS size FROM jobs WHERE status = 'ready' GROUP BY file)"
+    ).fetchone()[0]
+    if total > OUTPUT_QUOTA_BYTES:
+        victims = conn.execute(
+            "SELECT id, file FROM jobs WHERE status = 'ready' ORDER BY paid, created_at"
+        ).fetchall()
+        for row in victims:
+            if total <= OUTPUT_QUOTA_BYTES:
+                break
+            total -= expire_job(row["id"], row["file"])
+
+    # 3. Tombstones past their grace period
+    with conn:
+        conn.execute(
+            "DELETE FROM jobs WHERE status = 'expired' AND expires_at < ?",
+            (now - EXPIRED_RECORD_TTL,)
+        )
+
+    # 4. Scratch files left behind by crashed jobs, and untracked outputs
+    cutoff = now - JOB_TTL
+    for folder in WORK_FOLDERS:
+        remove_stale_entries(folder, cutoff)
+    remove_stale_entries(OUTPUT_FOLDER, cutoff, keep_referenced=True)
+
+def janitor_loop():
+    while True:
+        try:
+            sweep_outputs()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(JANITOR_INTERVAL)
+
+def start_janitor():
+    # One janitor per web process; pool workers don't need their own
+    if multiprocessing.parent_process() is not None:
+        return
+    threading.Thread(target=janitor_loop, name="output-janitor", daemon=True).start()
+
+init_retention()
+start_janitor()
+
+# ---------------- METRICS ----------------
+# Routes, tools and pool workers record timings into tools.metrics; each
+# process flushes its deltas into the job database (web processes at most every
+# METRICS_FLUSH_INTERVAL seconds, pool workers after every job). /metrics
+# serves the totals plus live gauges in Prometheus text format.
+
+METRICS_FLUSH_INTERVAL = 5
+
+_metrics_flushed_at = 0.0
+
+metrics.describe("http_request_duration_seconds", "Request latency by route.")
+metrics.describe("stage_duration_seconds", "Time spent in each processing stage.")
+metrics.describe("job_duration_seconds", "Wall time of background jobs.")
+metrics.describe("job_cpu_seconds", "CPU time of background jobs.")
+metrics.describe("jobs_total", "Finished background jobs by outcome.")
+metrics.describe("bytes_processed_total", "Bytes read from uploads and written to outputs.")
+metrics.describe("pdf_pages_total", "PDF pages by kind (text, scanned, blank).")
+metrics.describe("ocr_pages_total", "Pages sent through OCR.")
+metrics.describe("ocr_cache_lookups_total", "OCR page cache lookups by outcome.")
+metrics.describe("ocr_page_dpi_total", "OCR'd pages by the resolution they needed.")
+metrics.describe("csv_rows_removed_total", "Rows removed by each CSV cleaning step.")
+metrics.describe("csv_parallel_fallbacks_total", "Parallel CSV cleans redone sequentially.")
+metrics.describe("jobs_in_state", "Jobs currently queued or running.")
+metrics.describe("output_bytes", "Bytes held by ready outputs.")
+metrics.describe("result_cache_lookups_total", "Result cache lookups by outcome.")
+metrics.describe("result_cache_bytes", "Bytes of outputs indexed by the result cache.")
+metrics.describe("worker_processes", "Pool worker processes per web process.")
+metrics.describe("job_workers", "Most processes one parallel job may use.")
+metrics.describe("process_max_rss_bytes", "Peak RSS of this web process.")
+
+def flush_metrics():
+    global _metrics_flushed_at
+    metrics.flush(get_db())
+    _metrics_flushed_at = time.time()
+
+metrics.init_db(get_db())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started,
+                        route=route, method=request.method, status=response.status_code)
+    if time.time() - _metrics_flushed_at > METRICS_FLUSH_INTERVAL:
+        try:
+            flush_metrics()
+        except sqlite3.Error:
+            traceback.print_exc()
+    return response
+
+def live_gauges():
+    conn = get_db()
+    counts = dict(conn.execute(
+        "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+    ).fetchall())
+    output_bytes = conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM "
+        "(SELECT MAX(size) AS size FROM jobs WHERE status = 'ready' GROUP BY file)"
+    ).fetchone()[0]
+    cache = cache_stats()
+
+    samples = [
+        ("jobs_in_state", "gauge", {"state": state}, counts.get(state, 0))
+        for state in ("queued", "running")
+    ]
+    samples += [
+        ("output_bytes", "gauge", {}, output_bytes),
+        ("result_cache_lookups_total", "counter", {"result": "hit"}, cache["hits"]),
+        ("result_cache_lookups_total", "counter", {"result": "miss"}, cache["misses"]),
+        ("result_cache_bytes", "gauge", {}, cache["bytes"]),
+        ("worker_processes", "gauge", {}, WORKER_PROCESSES),
+        ("job_workers", "gauge", {}, JOB_WORKERS),
+        # ru_maxrss is in KiB on Linux
+        ("process_max_rss_bytes", "gauge", {"pid": os.getpid()},
+         resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+    ]
+    return samples
+
+@app.route("/metrics")
+def metrics_route():
+    flush_metrics()
+    body = metrics.render(get_db(), live_gauges())
+    return app.response_class(body, mimetype="text/plain; version=0.0.4")
 
 # ---------------- RAZORPAY ----------------
 
@@ -131,164 +942,222 @@ def about():
 
 # ---------------- INVOICE ----------------
 
+# ~2,000 rows of a typical invoice CSV
+INVOICE_PARALLEL_MIN_BYTES = int(os.environ.get("INVOICE_PARALLEL_MIN_BYTES", 200 * 1024))
+
+# Invoice CSVs are read in chunks and zipped as they render, so memory doesn't
+# grow with the upload and /invoice can take far more than MAX_CONTENT_LENGTH.
+# Anything over FREE_SIZE_MB is a paid job anyway.
+INVOICE_MAX_UPLOAD_BYTES = int(os.environ.get("INVOICE_MAX_UPLOAD_BYTES", 200 * 1024 * 1024))
+
+# Except output=pdf: the combined PDF is built in memory, so uploads with more
+# than INVOICE_COMBINED_MAX_ROWS invoices are turned away before queueing.
+
 @app.route("/invoice", methods=["POST"])
 def invoice():
+    visitor_id, is_free = None, False
+    request.max_content_length = INVOICE_MAX_UPLOAD_BYTES
     try:
         uploaded_file = request.files.get("file")
         if not uploaded_file or not uploaded_file.filename.endswith(".csv"):
             return jsonify({"error": "Invalid CSV file. Please upload a valid .csv file."}), 400
 
-        visitor_id = get_visitor_id(request)
-        file_size = uploaded_file.content_length or 0
-        is_free = can_use_free(visitor_id, file_size)
+        csv_upload, file_size = spool_upload(uploaded_file)
 
-        csv_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{uploaded_file.filename}")
-        uploaded_file.save(csv_path)
+        # output=pdf: one combined PDF with a bookmark per invoice instead of a zip of PDFs
+        combined = request.form.get("output") == "pdf"
+        if combined:
+            try:
+                check_combined_rows(open_input(csv_upload))
+            except ValueError as e:
+                discard_inputs([csv_upload])
+                return jsonify({"error": str(e)}), 400
 
-        invoice_output = os.path.join(OUTPUT_FOLDER, str(uuid.uuid4()))
-        pdf_files = generate_invoices(csv_path, invoice_output)
+        visitor_id = get_visitor_id(request)
+        is_free = claim_free_use(visitor_id, file_size)
 
-        output_filename = smart_rename("invoices", ".zip")
-        zip_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        with zipfile.ZipFile(zip_path, "w") as zipf:
-            for pdf in pdf_files:
-                zipf.write(pdf, os.path.basename(pdf))
+        output_filename = smart_rename("invoices", ".pdf" if combined else ".zip")
+        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
 
-        # Job Tracking
-        job_id = str(uuid.uuid4())
-        jobs = load_jobs()
-        jobs[job_id] = {
-            "file": zip_path,
-            "filename": output_filename,
-            "paid": False,
-            "free": is_free
-        }
-        save_jobs(jobs)
+        # Large uploads render across up to INVOICE_WORKERS processes
+        workers = min(INVOICE_WORKERS, JOB_WORKERS) if file_size >= INVOICE_PARALLEL_MIN_BYTES else 1
 
-        if is_free:
-            mark_free_used(visitor_id)
-        
-        # Cleanup input
-        if os.path.exists(csv_path): os.remove(csv_path)
+        # Job Tracking
+        job_id, status = start_job("invoice", run_invoice, [csv_upload], output_path,
+                                   output_filename, is_free, visitor_id, workers=workers,
+                                   combined=combined)
 
-        return jsonify({"status": "ready", "job_id": job_id, "free": is_free})
+        return jsonify({"status": status, "job_id": job_id, "free": is_free})
 
     except Exception as e:
         traceback.print_exc()
+        if is_free:
+            release_free_use(visitor_id)
         return jsonify({"error": "Failed to process invoice CSV. Ensure format is correct."}), 500
 
 # ---------------- CSV CLEANER ----------------
 
+# Below this the pool startup costs more than it saves; roughly 100k rows of
+# a typical export. Spooled uploads this size are always files on disk.
+CSV_PARALLEL_MIN_BYTES = int(os.environ.get("CSV_PARALLEL_MIN_BYTES", 16 * 1024 * 1024))
+
 @app.route("/csv-cleaner", methods=["POST"])
 def csv_cleaner_route():
+    visitor_id, is_free = None, False
     try:
         uploaded_file = request.files.get("file")
         if not uploaded_file or not uploaded_file.filename.endswith(".csv"):
             return jsonify({"error": "Invalid file. Please upload a .csv file."}), 400
 
-        visitor_id = get_visitor_id(request)
-        file_size = uploaded_file.content_length or 0
-        is_free = can_use_free(visitor_id, file_size)
+        output_format = request.form.get("format", "csv")
+        if output_format not in OUTPUT_FORMATS:
+            return jsonify({"error": f"Unknown format. Choose one of: {', '.join(OUTPUT_FORMATS)}"}), 400
+
+        # steps: JSON list of cleaning steps (see tools/clean_pipeline.py); default is the usual four
+        steps = request.form.get("steps")
+        if steps:
+            try:
+                steps = parse_steps(json.loads(steps))
+            except ValueError as e:
+                return jsonify({"error": f"Invalid steps: {e}"}), 400
+
+        # dedup=exact: confirm every duplicate against the original row, not just its hash
+        exact_dedup = request.form.get("dedup") == "exact"
+
+        csv_upload, file_size = spool_upload(uploaded_file)
+
+        if steps:
+            # Columns the steps name are checked against the header now, not in the job
+            try:
+                columns = read_header(open_input(csv_upload))
+            except (ValueError, UnicodeDecodeError):
+                columns = None  # unreadable: the job reports it
+            if columns is not None:
+                try:
+                    Pipeline(steps, columns, exact_dedup)
+                except ValueError as e:
+                    discard_inputs([csv_upload])
+                    return jsonify({"error": f"Invalid steps: {e}"}), 400
 
-        upload_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{uploaded_file.filename}")
-        uploaded_file.save(upload_path)
+        visitor_id = get_visitor_id(request)
+        is_free = claim_free_use(visitor_id, file_size)
 
         # Output with smart name
-        output_filename = smart_rename("cleaned_csv", ".csv")
-        output_path = os.path.join(OUTPUT_FOLDER, "csv_cleaner")
-        os.makedirs(output_path, exist_ok=True)
-        
-        # The tool returns the full path, so we might need to move/rename it or pass the name
-        # Looking at clean_csv signature, it takes input and output dir.
-        cleaned_file_path = clean_csv(upload_path, output_path)
-        
-        # Renaissance the file to our smart logic
+        output_filename = smart_rename("cleaned_csv", OUTPUT_FORMATS[output_format])
         final_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        shutil.move(cleaned_file_path, final_path)
-
-        job_id = str(uuid.uuid4())
-        jobs = load_jobs()
-        jobs[job_id] = {
-            "file": final_path,
-            "filename": output_filename,
-            "paid": False,
-            "free": is_free
-        }
-        save_jobs(jobs)
 
-        if is_free:
-            mark_free_used(visitor_id)
-            
-        if os.path.exists(upload_path): os.remove(upload_path)
+        # Large uploads are cleaned across up to CSV_WORKERS processes
+        workers = min(CSV_WORKERS, JOB_WORKERS) if file_size >= CSV_PARALLEL_MIN_BYTES else 1
+
+        job_id, status = start_job("csv_cleaner", run_csv_cleaner, [csv_upload], final_path,
+                                   output_filename, is_free, visitor_id, exact_dedup=exact_dedup,
+                                   output_format=output_format, workers=workers, steps=steps or None)
 
-        return jsonify({"status": "ready", "job_id": job_id, "free": is_free})
+        return jsonify({"status": status, "job_id": job_id, "free": is_free})
 
     except Exception as e:
         traceback.print_exc()
+        if is_free:
+            release_free_use(visitor_id)
         return jsonify({"error": "Could not clean CSV. File might be empty or corrupted."}), 500
 
 # ---------------- PDF ----------------
 
 @app.route("/pdf-to-excel", methods=["POST"])
 def pdf_to_excel_route():
+    visitor_id, is_free = None, False
     try:
         uploaded_file = request.files.get("file")
         if not uploaded_file or not uploaded_file.filename.endswith(".pdf"):
             return jsonify({"error": "Invalid file. Please upload a .pdf file."}), 400
 
-        visitor_id = get_visitor_id(request)
-        file_size = uploaded_file.content_length or 0
-        is_free = can_use_free(visitor_id, file_size)
+        pdf_upload, file_size = spool_upload(uploaded_file)
 
-        pdf_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}_{uploaded_file.filename}")
-        uploaded_file.save(pdf_path)
+        visitor_id = get_visitor_id(request)
+        is_free = claim_free_use(visitor_id, file_size)
 
-        output_subfolder = os.path.join(OUTPUT_FOLDER, "pdf_to_excel")
-        os.makedirs(output_subfolder, exist_ok=True)
-        
-        # Tool returns path to "output.xlsx" usually
-        excel_file = pdf_to_excel(pdf_path, output_subfolder)
-        
-        # Rename
         output_filename = smart_rename("ocr_excel", ".xlsx")
         final_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        shutil.move(excel_file, final_path)
-
-        job_id = str(uuid.uuid4())
-        jobs = load_jobs()
-        jobs[job_id] = {
-            "file": final_path,
-            "filename": output_filename,
-            "paid": False,
-            "free": is_free
-        }
-        save_jobs(jobs)
 
-        if is_free:
-            mark_free_used(visitor_id)
-            
-        if os.path.exists(pdf_path): os.remove(pdf_path)
+        # Pages are spread across up to PDF_WORKERS processes; short documents
+        # stay in-process (see PDF_PARALLEL_MIN_PAGES)
+        job_id, status = start_job("pdf_to_excel", run_pdf_to_excel, [pdf_upload], final_path,
+                                   output_filename, is_free, visitor_id,
+                                   workers=min(PDF_WORKERS, JOB_WORKERS))
 
-        return jsonify({"status": "ready", "job_id": job_id, "free": is_free})
+        return jsonify({"status": status, "job_id": job_id, "free": is_free})
 
     except Exception as e:
         traceback.print_exc()
+        if is_free:
+            release_free_use(visitor_id)
         return jsonify({"error": "PDF conversion failed. File might be password protected or corrupted."}), 500
 
 # ---------------- DOWNLOAD ----------------
+# Outputs never change once ready, so size + mtime make a strong ETag and
+# send_file answers Range requests and If-None-Match / If-Modified-Since
+# itself. DOWNLOAD_OFFLOAD hands the bytes to a front proxy instead:
+#   "x-accel"    -> nginx internal location at X_ACCEL_PREFIX mapped to OUTPUT_FOLDER
+#   "x-sendfile" -> Apache/lighttpd mod_xsendfile with the absolute path
+
+DOWNLOAD_OFFLOAD = os.environ.get("DOWNLOAD_OFFLOAD", "")
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/protected-outputs/")
+app.config["USE_X_SENDFILE"] = DOWNLOAD_OFFLOAD == "x-sendfile"
+
+def output_etag(stat):
+    return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def download_mimetype(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSED_MIMETYPES:
+        return COMPRESSED_MIMETYPES[ext]
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+def accel_redirect(path, filename):
+    rel = os.path.relpath(path, OUTPUT_FOLDER).replace(os.sep, "/")
+    response = app.response_class(status=200)
+    response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX.rstrip("/") + "/" + url_quote(rel)
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    response.content_type = download_mimetype(filename)
+    return response
 
 @app.route("/download/<job_id>")
 def download_file(job_id):
-    jobs = load_jobs()
-    if job_id not in jobs:
+    job = get_job(job_id)
+    if job is None:
         abort(404)
 
-    job = jobs[job_id]
+    if job["status"] == "expired" or job["expires_at"] < time.time():
+        return "Download link expired", 410
+
+    if job["status"] != "ready":
+        return "File not ready", 409
 
     if job.get("free") or job.get("paid"):
-        filename = job.get("filename", os.path.basename(job["file"]))
-        return send_file(job["file"], as_attachment=True, download_name=filename)
+        filename = job.get("filename") or os.path.basename(job["file"])
+
+        if DOWNLOAD_OFFLOAD == "x-accel":
+            return accel_redirect(job["file"], filename)
+
+        try:
+            stat = os.stat(job["file"])
+        except FileNotFoundError:
+            return "Download link expired", 410
+
+        response = send_file(
+            os.path.abspath(job["file"]),
+            as_attachment=True,
+            download_name=filename,
+            mimetype=download_mimetype(filename),
+            conditional=True,
+            etag=output_etag(stat),
+            last_modified=stat.st_mtime,
+            max_age=3600
+        )
+        # Paid downloads must not be cached by shared proxies
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response
 
     return "Payment required", 403
 
@@ -296,96 +1165,61 @@ def download_file(job_id):
 
 @app.route("/pdf-merge", methods=["POST"])
 def pdf_merge_route():
+    visitor_id, is_free = None, False
     try:
         uploaded_files = request.files.getlist("files")
         if not uploaded_files or len(uploaded_files) < 2:
             return jsonify({"error": "Need at least 2 PDFs to merge."}), 400
 
-        visitor_id = get_visitor_id(request)
-        total_size = sum([f.content_length or 0 for f in uploaded_files])
-        is_free = can_use_free(visitor_id, total_size)
-
-        input_paths = []
+        inputs = []
+        total_size = 0
         for f in uploaded_files:
-            path = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()) + "_" + f.filename)
-            f.save(path)
-            input_paths.append(path)
+            upload, size = spool_upload(f)
+            inputs.append(upload)
+            total_size += size
+
+        visitor_id = get_visitor_id(request)
+        is_free = claim_free_use(visitor_id, total_size)
 
         output_filename = smart_rename("pdf_merge", ".pdf")
         output_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        merge_pdfs(input_paths, output_path)
-
-        # Cleanup inputs
-        for p in input_paths:
-            if os.path.exists(p): os.remove(p)
-
-        job_id = str(uuid.uuid4())
-        jobs = load_jobs()
-        jobs[job_id] = {
-            "file": output_path,
-            "filename": output_filename,
-            "paid": False,
-            "free": is_free
-        }
-        save_jobs(jobs)
 
-        if is_free:
-            mark_free_used(visitor_id)
+        job_id, status = start_job("pdf_merge", run_pdf_merge, inputs, output_path,
+                                   output_filename, is_free, visitor_id)
 
-        return jsonify({"status": "ready", "job_id": job_id, "free": is_free})
+        return jsonify({"status": status, "job_id": job_id, "free": is_free})
 
     except Exception as e:
         traceback.print_exc()
+        if is_free:
+            release_free_use(visitor_id)
         return jsonify({"error": "Merge failed. Some files might be corrupted."}), 500
 
 @app.route("/pdf-split", methods=["POST"])
 def pdf_split_route():
+    visitor_id, is_free = None, False
     try:
         uploaded_file = request.files.get("file")
         if not uploaded_file or not uploaded_file.filename.endswith(".pdf"):
             return jsonify({"error": "Invalid PDF file."}), 400
 
-        visitor_id = get_visitor_id(request)
-        file_size = uploaded_file.content_length or 0
-        is_free = can_use_free(visitor_id, file_size)
+        pdf_upload, file_size = spool_upload(uploaded_file)
 
-        pdf_path = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()) + "_" + uploaded_file.filename)
-        uploaded_file.save(pdf_path)
-
-        split_dir = os.path.join(OUTPUT_FOLDER, str(uuid.uuid4()) + "_split")
-        split_files = split_pdf(pdf_path, split_dir)
+        visitor_id = get_visitor_id(request)
+        is_free = claim_free_use(visitor_id, file_size)
 
         output_filename = smart_rename("pdf_split", ".zip")
         zip_path = os.path.join(OUTPUT_FOLDER, output_filename)
-        
-        with zipfile.ZipFile(zip_path, "w") as zipf:
-            for f in split_files:
-                zipf.write(f, os.path.basename(f))
-
-        # Cleanup inputs and split folder
-        if os.path.exists(pdf_path): os.remove(pdf_path)
-        for f in split_files:
-            if os.path.exists(f): os.remove(f)
-        if os.path.exists(split_dir): os.rmdir(split_dir)
-
-        job_id = str(uuid.uuid4())
-        jobs = load_jobs()
-        jobs[job_id] = {
-            "file": zip_path,
-            "filename": output_filename,
-            "paid": False,
-            "free": is_free
-        }
-        save_jobs(jobs)
 
-        if is_free:
-            mark_free_used(visitor_id)
+        job_id, status = start_job("pdf_split", run_pdf_split, [pdf_upload], zip_path,
+                                   output_filename, is_free, visitor_id)
 
-        return jsonify({"status": "ready", "job_id": job_id, "free": is_free})
+        return jsonify({"status": status, "job_id": job_id, "free": is_free})
 
     except Exception as e:
         traceback.print_exc()
+        if is_free:
+            release_free_use(visitor_id)
         return jsonify({"error": "Split failed. File might be corrupted."}), 500
 
 # ---------------- EXCEL FORMULA ----------------
@@ -413,11 +1247,21 @@ def excel_formula_route():
 
 @app.route("/check-status/<job_id>")
 def check_status(job_id):
-    jobs = load_jobs()
-    if job_id not in jobs:
+    job = get_job(job_id)
+    if job is None:
         return jsonify({"status": "not_found"})
 
-    if jobs[job_id].get("free") or jobs[job_id].get("paid"):
+    if job["status"] in ("queued", "running"):
+        return jsonify({"status": job["status"], "progress": job["progress"]})
+
+    if job["status"] == "failed":
+        return jsonify({"status": "failed", "error": job["error"]})
+
+    if job["status"] == "expired":
+        return jsonify({"status": "expired"})
+
+    # Ready: downloadable once free or paid
+    if job["free"] or job["paid"]:
         return jsonify({"status": "paid"})
 
     return jsonify({"status": "pending"})
@@ -444,10 +1288,8 @@ def razorpay_webhook():
         payment = data["payload"]["payment"]["entity"]
         job_id = payment["notes"].get("job_id")
 
-        jobs = load_jobs()
-        if job_id in jobs:
-            jobs[job_id]["paid"] = True
-            save_jobs(jobs)
+        if job_id:
+            mark_job_paid(job_id)
 
     return "OK", 200
 
@@ -0,0 +1,245 @@
+"""
+Deterministic synthetic inputs for the benchmark suite.
+
+Every generator takes a size and a seed and writes the same bytes on every run,
+so results can be compared between commits. Files are cached under
+benchmarks/.fixtures/ and only regenerated when missing.
+"""
+
+import csv
+import io
+import os
+import random
+import zlib
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fixtures")
+
+FIRST_NAMES = ["Rahul", "Amit", "Sumit", "Priya", "Neha", "Vikram", "Anjali", "Karan", "Pooja", "Arjun"]
+LAST_NAMES = ["Sharma", "Verma", "Saxena", "Gupta", "Singh", "Mehta", "Iyer", "Reddy", "Das", "Kapoor"]
+CITIES = ["Delhi", "Mumbai", "Pune", "Chennai", "Kolkata", "Jaipur", "Lucknow", "Bengaluru"]
+SERVICES = ["Website Work", "Automation Script", "SEO Audit", "Logo Design", "Data Cleanup", "Consulting"]
+GST_RATES = [0, 5, 12, 18, 28]
+
+def fixture_path(name):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    return os.path.join(FIXTURE_DIR, name)
+
+def _cached(name, write):
+    path = fixture_path(name)
+    if not os.path.exists(path):
+        tmp = path + ".tmp"
+        write(tmp)
+        os.replace(tmp, path)
+    return path
+
+# ---------------- CSV ----------------
+
+def invoice_csv(rows, seed=1):
+    """Invoice upload with the Invoice_No/Quantity/Rate/GST_Percent schema."""
+    def write(path):
+        rng = random.Random(seed)
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(["Invoice_No", "Invoice_Date", "Customer_Name", "Customer_Address",
+                        "Service_Name", "Quantity", "Rate", "GST_Percent"])
+            for i in range(rows):
+                w.writerow([
+                    1000 + i,
+                    f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                    f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                    rng.choice(CITIES),
+                    rng.choice(SERVICES),
+                    rng.randint(1, 20),
+                    rng.choice([500, 1200, 2000, 3000, 5000, 7500]),
+                    rng.choice(GST_RATES),
+                ])
+    return _cached(f"invoices_{rows}_{seed}.csv", write)
+
+def dirty_csv(rows, columns=12, seed=2):
+    """
+    CSV with the mess clean_csv is meant to fix: padded strings, messy
+    headers, fully empty rows and ~10% duplicate rows.
+    """
+    def write(path):
+        rng = random.Random(seed)
+        headers = [f" Column {i} Name " if i % 3 else f"VALUE {i}" for i in range(columns)]
+        recent = []
+        with open(path, "w", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(headers)
+            for i in range(rows):
+                r = rng.random()
+                if r < 0.02:
+                    w.writerow([""] * columns)
+                    continue
+                if r < 0.12 and recent:
+                    w.writerow(rng.choice(recent))
+                    continue
+                row = []
+                for c in range(columns):
+                    if c % 3 == 0:
+                        row.append(rng.randint(0, 100000))
+                    elif c % 3 == 1:
+                        row.append(f"  {rng.choice(FIRST_NAMES)} {rng.choice(CITIES)}  ")
+                    else:
+                        row.append("" if rng.random() < 0.05 else f"{rng.choice(SERVICES)} ")
+                w.writerow(row)
+                recent.append(row)
+                if len(recent) > 1000:
+                    recent.pop(0)
+    return _cached(f"dirty_{rows}x{columns}_{seed}.csv", write)
+
+# ---------------- PDF ----------------
+
+STATEMENT_HEADER = ["Date", "Description", "Debit", "Credit", "Balance"]
+# Column widths in characters; the numeric columns are right-aligned
+STATEMENT_WIDTHS = [12, 28, 12, 12, 14]
+STATEMENT_RIGHT = [False, False, True, True, True]
+
+def _table_rows(rng, count):
+    rows = [STATEMENT_HEADER]
+    balance = 100000.0
+    for _ in range(count - 1):
+        debit = rng.choice([0, 0, rng.randint(100, 9000)])
+        credit = 0 if debit else rng.randint(100, 9000)
+        balance += credit - debit
+        rows.append([
+            f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            rng.choice(SERVICES) + ' ' + rng.choice(CITIES),
+            f"{debit:.2f}", f"{credit:.2f}", f"{balance:.2f}",
+        ])
+    return rows
+
+def _table_lines(rng, count):
+    return [
+        "".join(cell.rjust(width) if right else cell.ljust(width)
+                for cell, width, right in zip(row, STATEMENT_WIDTHS, STATEMENT_RIGHT))
+        for row in _table_rows(rng, count)
+    ]
+
+def statement_cells(pages, lines_per_page=40, seed=4):
+    """Per page, the table rows scanned_pdf() draws: the ground truth for OCR."""
+    rng = random.Random(seed)
+    return [_table_rows(rng, lines_per_page) for _ in range(pages)]
+
+def _escape_pdf_text(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def text_pdf(pages, lines_per_page=40, seed=3):
+    """Text-layer PDF (statement-style rows), written directly as PDF objects."""
+    def write(path):
+        rng = random.Random(seed)
+        objects = []
+
+        def add(body):
+            objects.append(body)
+            return len(objects)
+
+        catalog = add(None)
+        pages_obj = add(None)
+        font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>")
+
+        page_ids = []
+        for _ in range(pages):
+            ops = ["BT", "/F1 9 Tf", "11 TL", "36 800 Td"]
+            for line in _table_lines(rng, lines_per_page):
+                ops.append(f"({_escape_pdf_text(line)}) Tj T*")
+            ops.append("ET")
+            stream = zlib.compress("\n".join(ops).encode("latin-1"))
+            content = add(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+            page_ids.append(add(
+                b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] "
+                b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (pages_obj, font, content)
+            ))
+
+        objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_obj
+        kids = b" ".join(b"%d 0 R" % p for p in page_ids)
+        objects[pages_obj - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+        out = io.BytesIO()
+        out.write(b"%PDF-1.4\n")
+        offsets = []
+        for i, body in enumerate(objects, start=1):
+            offsets.append(out.tell())
+            out.write(b"%d 0 obj\n" % i + body + b"\nendobj\n")
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for off in offsets:
+            out.write(b"%010d 00000 n \n" % off)
+        out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref))
+
+        with open(path, "wb") as f:
+            f.write(out.getvalue())
+    return _cached(f"text_{pages}p_{seed}.pdf", write)
+
+def scanned_pdf(pages, lines_per_page=40, dpi=150, seed=4):
+    """
+    Image-only PDF (no text layer) of the same statement rows, for the OCR
+    path. Rows match statement_cells() with the same arguments.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    def write(path):
+        rng = random.Random(seed)
+        width, height = int(8.27 * dpi), int(11.69 * dpi)
+        try:
+            font = ImageFont.load_default(size=int(dpi / 8))
+        except TypeError:
+            font = ImageFont.load_default()
+
+        images = []
+        for _ in range(pages):
+            img = Image.new("L", (width, height), 255)
+            draw = ImageDraw.Draw(img)
+            y = dpi // 2
+            char = font.getlength("0")
+            for row in _table_rows(rng, lines_per_page):
+                # each cell at its column, as on a real statement
+                x = dpi // 2
+                for cell, chars, right in zip(row, STATEMENT_WIDTHS, STATEMENT_RIGHT):
+                    left = x + chars * char - font.getlength(cell) if right else x
+                    draw.text((left, y), cell, fill=0, font=font)
+                    x += chars * char
+                y += int(dpi / 6)
+            images.append(img)
+
+        images[0].save(path, "PDF", resolution=dpi, save_all=True, append_images=images[1:])
+    return _cached(f"scanned_{pages}p_{dpi}dpi_{seed}_columns.pdf", write)
+
+# ---------------- FORMULA PROMPTS ----------------
+
+PROMPT_TEMPLATES = [
+    "sum column {col}",
+    "average of {col} where {col2} greater than {n}",
+    "if {cell} greater than {n} then Pass else Fail",
+    "count blank cells in {col}",
+    "vlookup {cell} in sheet2 column {col2}",
+    "agar {cell} zyada hai {n} se to yes warna no",
+    "aaj ki date",
+    "age from date of birth in {cell}",
+    "trim spaces in {cell}",
+    "round {cell} to 2 decimals",
+    "concat {cell} and {cell2} with space",
+    "count if {col} equals {n}",
+    "max of {col}",
+    "percentage of {cell} out of {cell2}",
+    "if {cell} is blank show na",
+    "sumifs {col} where {col2} is delhi and {col3} more than {n}",
+    "left 3 characters of {cell}",
+    "index match {cell} in {col2}",
+    "",
+    "random gibberish qwerty zxcv",
+]
+
+def formula_prompts(count, seed=5):
+    rng = random.Random(seed)
+    cols = "ABCDEFGH"
+    prompts = []
+    for _ in range(count):
+        c1, c2, c3 = rng.sample(cols, 3)
+        prompts.append(rng.choice(PROMPT_TEMPLATES).format(
+            col=c1, col2=c2, col3=c3,
+            cell=f"{c1}{rng.randint(1, 50)}", cell2=f"{c2}{rng.randint(1, 50)}",
+            n=rng.choice([10, 50, 100, 500, 1000]),
+        ))
+    return prompts
@@ -0,0 +1,110 @@
+"""
+OCR table extraction: word boxes (tools.ocr_tables.ocr_tables) against the old
+round trip through a searchable PDF (ocr_tables_via_pdf), on the scanned
+statement fixture whose true cells are known.
+
+    python -m benchmarks.ocr_tables --pages 5
+    python -m benchmarks.ocr_tables --pages 20 --output ocr.json
+
+Pages are rendered at 300 DPI once, outside the timing, so each method is
+timed on OCR plus table building only. Fidelity per method:
+
+- cell_recall: share of the true cells found anywhere in the extracted tables
+- row_exact_rate: share of the true rows extracted exactly, cell for cell
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import pdfplumber
+
+from benchmarks import fixtures
+from benchmarks.run import git_commit, percentile
+from tools.ocr_tables import ocr_tables, ocr_tables_via_pdf
+
+METHODS = {
+    "words": ocr_tables,
+    "pdf": ocr_tables_via_pdf,
+}
+
+def _normalize(cell):
+    return " ".join((cell or "").split())
+
+def fidelity(pages_tables, truth):
+    """(cell_recall, row_exact_rate) of extracted tables against the true rows, per page."""
+    true_cells = found_cells = true_rows = exact_rows = 0
+    for tables, rows in zip(pages_tables, truth):
+        extracted = [tuple(_normalize(c) for c in row) for table in tables for row in table]
+        cells = Counter(c for row in extracted for c in row if c)
+        wanted = Counter(c for row in rows for c in row)
+        true_cells += sum(wanted.values())
+        found_cells += sum((cells & wanted).values())
+
+        extracted_rows = Counter(extracted)
+        true_rows += len(rows)
+        exact_rows += sum((extracted_rows & Counter(tuple(row) for row in rows)).values())
+    return found_cells / true_cells, exact_rows / true_rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare OCR table extraction methods.")
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--methods", default=",".join(METHODS), help="Comma-separated, from: words, pdf")
+    parser.add_argument("--output", help="Write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    methods = [m.strip() for m in args.methods.split(",") if m.strip()]
+    unknown = [m for m in methods if m not in METHODS]
+    if unknown:
+        parser.error(f"Unknown method(s): {', '.join(unknown)}")
+
+    truth = fixtures.statement_cells(args.pages)
+    with pdfplumber.open(fixtures.scanned_pdf(args.pages)) as pdf:
+        images = [page.to_image(resolution=300).original for page in pdf.pages]
+
+    results = []
+    for method in methods:
+        extract = METHODS[method]
+        latencies = []
+        pages_tables = []
+        try:
+            for image in images:
+                start = time.perf_counter()
+                tables, _ = extract(image)
+                latencies.append(time.perf_counter() - start)
+                pages_tables.append(tables)
+        except Exception as e:
+            results.append({"method": method, "error": f"{type(e).__name__}: {e}"})
+            continue
+
+        cell_recall, row_exact_rate = fidelity(pages_tables, truth)
+        results.append({
+            "method": method,
+            "pages": len(images),
+            "total_s": sum(latencies),
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p99_s": percentile(latencies, 99),
+            "tables": sum(len(tables) for tables in pages_tables),
+            "cell_recall": cell_recall,
+            "row_exact_rate": row_exact_rate,
+        })
+        result = results[-1]
+        print(f"{method}: {result['latency_p50_s'] * 1000:.0f} ms/page p50, "
+              f"cells {cell_recall:.1%}, exact rows {row_exact_rate:.1%}", file=sys.stderr)
+
+    text = json.dumps({"meta": {"commit": git_commit(), "pages": args.pages}, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
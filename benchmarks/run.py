@@ -0,0 +1,302 @@
+"""
+Benchmark suite for every tool.
+
+    python -m benchmarks.run --scale quick
+    python -m benchmarks.run --scale full --only invoice,csv_cleaner --output bench.json
+
+Each case runs in a fresh (spawned) process so peak RSS belongs to that case
+alone. Results are printed as JSON: throughput in items/second (rows, pages or
+prompts), p50/p99 latency and peak RSS, plus the commit they were measured on.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Repeated runs would otherwise measure OCR cache hits; set OCR_CACHE_PATH to include the cache
+os.environ.setdefault("OCR_CACHE_PATH", "")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import fixtures
+from tools.invoice_tool import generate_invoices, generate_combined_invoice_pdf, INVOICE_WORKERS
+from tools.csv_cleaner import clean_csv, CSV_WORKERS
+from tools.pdf_to_excel import pdf_to_excel, PDF_WORKERS
+from tools.pdf_processor import merge_pdfs, split_pdf
+from tools.excel_formula_engine import generate_formula
+
+# Sizes per tool. Units: rows for CSV tools, pages for PDF tools, prompts for formulas.
+SCALES = {
+    "quick": {
+        "invoice": [10],
+        "invoice_parallel": [10],
+        "invoice_combined": [10],
+        "csv_cleaner": [1000],
+        "csv_cleaner_exact": [1000],
+        "csv_cleaner_parallel": [1000],
+        "csv_cleaner_pipeline": [1000],
+        "pdf_to_excel_text": [1],
+        "pdf_to_excel_scanned": [1],
+        "pdf_to_excel_scanned_parallel": [4],
+        "pdf_merge": [1],
+        "pdf_split": [1],
+        "formula": [200],
+    },
+    "standard": {
+        "invoice": [10, 1000],
+        "invoice_parallel": [1000],
+        "invoice_combined": [10, 1000],
+        "csv_cleaner": [1000, 100000],
+        "csv_cleaner_exact": [100000],
+        "csv_cleaner_parallel": [100000],
+        "csv_cleaner_pipeline": [100000],
+        "pdf_to_excel_text": [1, 10, 100],
+        "pdf_to_excel_scanned": [1, 10],
+        "pdf_to_excel_scanned_parallel": [10],
+        "pdf_merge": [1, 10, 100],
+        "pdf_split": [1, 10, 100],
+        "formula": [2000],
+    },
+    "full": {
+        "invoice": [10, 1000, 50000],
+        "invoice_parallel": [1000, 50000],
+        "invoice_combined": [10, 1000, 50000],
+        "csv_cleaner": [1000, 100000, 1000000],
+        "csv_cleaner_exact": [100000, 1000000],
+        "csv_cleaner_parallel": [100000, 1000000],
+        "csv_cleaner_pipeline": [100000, 1000000],
+        "pdf_to_excel_text": [1, 10, 100, 500],
+        "pdf_to_excel_scanned": [1, 10, 100, 500],
+        "pdf_to_excel_scanned_parallel": [10, 100, 500],
+        "pdf_merge": [1, 10, 100, 500],
+        "pdf_split": [1, 10, 100, 500],
+        "formula": [2000, 20000],
+    },
+}
+
+UNITS = {
+    "invoice": "rows",
+    "invoice_parallel": "rows",
+    "invoice_combined": "rows",
+    "csv_cleaner": "rows",
+    "csv_cleaner_exact": "rows",
+    "csv_cleaner_parallel": "rows",
+    "csv_cleaner_pipeline": "rows",
+    "pdf_to_excel_text": "pages",
+    "pdf_to_excel_scanned": "pages",
+    "pdf_to_excel_scanned_parallel": "pages",
+    "pdf_merge": "pages",
+    "pdf_split": "pages",
+    "formula": "prompts",
+}
+
+# Every kind of step, for the csv_cleaner_pipeline case
+PIPELINE_STEPS = [
+    {"step": "drop_columns", "columns": ["column 1 name"]},
+    "drop_empty_rows",
+    "collapse_whitespace",
+    "trim",
+    {"step": "coerce", "columns": ["value 0", "value 3"], "to": "number"},
+    {"step": "lowercase", "columns": ["column 2 name"]},
+    "dedupe",
+    "normalize_headers",
+]
+
+# ---------------- CASES ----------------
+# prepare() builds the fixture (outside any timing) and returns its argument;
+# run_once() does one measured run. A run may return a list of per-item latencies
+# (used for formulas, where one "run" is the whole prompt corpus).
+
+def prepare(tool, size):
+    if tool in ("invoice", "invoice_parallel", "invoice_combined"):
+        return fixtures.invoice_csv(size)
+    if tool in ("csv_cleaner", "csv_cleaner_exact", "csv_cleaner_parallel", "csv_cleaner_pipeline"):
+        return fixtures.dirty_csv(size)
+    if tool in ("pdf_to_excel_text", "pdf_merge", "pdf_split"):
+        return fixtures.text_pdf(size)
+    if tool in ("pdf_to_excel_scanned", "pdf_to_excel_scanned_parallel"):
+        return fixtures.scanned_pdf(size)
+    if tool == "formula":
+        return fixtures.formula_prompts(size)
+    raise ValueError(f"Unknown tool: {tool}")
+
+def run_once(tool, fixture, workdir):
+    if tool == "invoice":
+        generate_invoices(fixture, workdir)
+    elif tool == "invoice_parallel":
+        generate_invoices(fixture, workdir, workers=INVOICE_WORKERS)
+    elif tool == "invoice_combined":
+        generate_combined_invoice_pdf(fixture, os.path.join(workdir, "invoices.pdf"))
+    elif tool == "csv_cleaner":
+        clean_csv(fixture, workdir)
+    elif tool == "csv_cleaner_exact":
+        clean_csv(fixture, workdir, exact_dedup=True)
+    elif tool == "csv_cleaner_parallel":
+        clean_csv(fixture, workdir, workers=CSV_WORKERS)
+    elif tool == "csv_cleaner_pipeline":
+        clean_csv(fixture, workdir, steps=PIPELINE_STEPS)
+    elif tool.startswith("pdf_to_excel"):
+        # pdf_to_excel never raises: a missing tesseract only shows up as
+        # failed pages, which would otherwise be timed as if OCR had run
+        failures = []
+        workers = PDF_WORKERS if tool.endswith("_parallel") else 1
+        pdf_to_excel(fixture, workdir, workers=workers, failures=failures)
+        if failures:
+            where, error = failures[0]
+            raise RuntimeError(f"{len(failures)} failure(s), first on {where}: {error}")
+    elif tool == "pdf_merge":
+        merge_pdfs([fixture, fixture], os.path.join(workdir, "merged.pdf"))
+    elif tool == "pdf_split":
+        split_pdf(fixture, workdir)
+    elif tool == "formula":
+        latencies = []
+        for prompt in fixture:
+            start = time.perf_counter()
+            generate_formula(prompt)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+def items_per_run(tool, size):
+    # A merge reads both copies of the fixture
+    return size * 2 if tool == "pdf_merge" else size
+
+def output_bytes(workdir):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(workdir) for name in names
+    )
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+def _case_worker(tool, size, fixture, repeat, queue):
+    os.chdir(REPO_ROOT)
+    result = {"tool": tool, "size": size, "unit": UNITS[tool], "repeat": repeat}
+    try:
+        run_latencies = []
+        item_latencies = []
+        written = None
+        for _ in range(repeat):
+            workdir = tempfile.mkdtemp(prefix="bench_")
+            try:
+                start = time.perf_counter()
+                per_item = run_once(tool, fixture, workdir)
+                run_latencies.append(time.perf_counter() - start)
+                written = output_bytes(workdir)
+                if per_item:
+                    item_latencies.extend(per_item)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        latencies = item_latencies or run_latencies
+        total = sum(run_latencies)
+        items = items_per_run(tool, size) * repeat
+        result.update({
+            "items": items,
+            "total_s": total,
+            "throughput_per_s": items / total if total else None,
+            "latency_scope": "item" if item_latencies else "run",
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p99_s": percentile(latencies, 99),
+            "output_bytes": written,
+        })
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    # ru_maxrss is KiB on Linux, bytes on macOS. RUSAGE_CHILDREN covers the
+    # pool workers of the *_parallel cases (and wkhtmltopdf/tesseract), once
+    # they have exited: the largest single child, not their sum.
+    scale = 1 if sys.platform == "darwin" else 1024
+    result["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    result["children_peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    queue.put(result)
+
+def run_case(tool, size, repeat, timeout):
+    fixture = prepare(tool, size)
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_case_worker, args=(tool, size, fixture, repeat, queue))
+    proc.start()
+    try:
+        result = queue.get(timeout=timeout)
+    except Exception:
+        proc.kill()
+        result = {"tool": tool, "size": size, "unit": UNITS[tool], "repeat": repeat,
+                  "error": f"Timed out after {timeout}s"}
+    proc.join()
+    result["case"] = f"{tool}/{UNITS[tool]}={size}"
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the automation tools.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="quick")
+    parser.add_argument("--only", help="Comma-separated tools, e.g. invoice,pdf_split")
+    parser.add_argument("--repeat", type=int, default=3, help="Measured runs per case")
+    parser.add_argument("--timeout", type=int, default=3600, help="Seconds allowed per case")
+    parser.add_argument("--output", help="Write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    plan = SCALES[args.scale]
+    if args.only:
+        wanted = [t.strip() for t in args.only.split(",") if t.strip()]
+        unknown = [t for t in wanted if t not in plan]
+        if unknown:
+            parser.error(f"Unknown tool(s): {', '.join(unknown)}. Choose from {', '.join(plan)}")
+        plan = {t: plan[t] for t in wanted}
+
+    results = []
+    for tool, sizes in plan.items():
+        for size in sizes:
+            result = run_case(tool, size, args.repeat, args.timeout)
+            print(f"{result['case']}: "
+                  + (result.get("error") or f"{result['throughput_per_s']:.1f} {UNITS[tool]}/s, "
+                     f"p50 {result['latency_p50_s'] * 1000:.2f} ms, "
+                     f"peak RSS {result['peak_rss_bytes'] / 2**20:.0f} MiB "
+                     f"(children {result['children_peak_rss_bytes'] / 2**20:.0f} MiB)"),
+                  file=sys.stderr)
+            results.append(result)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "scale": args.scale,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import pandas as pd
+
+from tools.csv_cleaner import clean_csv
+from tools.dedup import DuplicateFilter
+
+def thue_morse(length):
+    return "".join("ab"[bin(i).count("1") % 2] for i in range(length))
+
+# Distinct cells that shared a fingerprint under the old unkeyed polynomial hash
+CELL = thue_morse(4096)
+COMPLEMENT = CELL.translate(str.maketrans("ab", "ba"))
+
+def test_colliding_pair_is_kept(tmp_path):
+    path = tmp_path / "pair.csv"
+    path.write_text(f"cell\n{CELL}\n{COMPLEMENT}\n{CELL}\n")
+
+    for exact in (False, True):
+        output = clean_csv(str(path), str(tmp_path / f"out_{exact}"), exact_dedup=exact)
+        assert pd.read_csv(output)["cell"].tolist() == [CELL, COMPLEMENT]
+
+def test_filter_keeps_colliding_pair_across_chunks():
+    with DuplicateFilter() as duplicates:
+        first = pd.DataFrame({"cell": pd.array([CELL], dtype="string[pyarrow]")})
+        second = pd.DataFrame({"cell": pd.array([COMPLEMENT, CELL], dtype="string[pyarrow]")})
+        assert duplicates.keep_mask(first).tolist() == [True]
+        assert duplicates.keep_mask(second).tolist() == [True, False]
@@ -0,0 +1,92 @@
+import importlib
+import io
+import os
+import sys
+
+import pytest
+from pypdf import PdfWriter
+
+from benchmarks import fixtures
+from tools import invoice_tool
+
+@pytest.fixture(scope="module")
+def app_module(tmp_path_factory):
+    # app.py keeps its job database, uploads and outputs relative to the
+    # working directory, and its janitor thread sweeps them from there
+    os.chdir(tmp_path_factory.mktemp("app"))
+    sys.modules.pop("app", None)
+    return importlib.import_module("app")
+
+def _blank_pdf(pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(100, 100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+@pytest.fixture
+def flaky_pdfkit(monkeypatch):
+    """pdfkit stand-in: batches fail, and so does the first single invoice."""
+    calls = []
+
+    def from_file(paths, output_path, options=None):
+        raise OSError("wkhtmltopdf exited with code 1")
+
+    def from_string(html, output_path, options=None):
+        calls.append(html)
+        if len(calls) == 1:
+            raise OSError("wkhtmltopdf exited with code 1")
+        return _blank_pdf(1)
+
+    monkeypatch.setattr(invoice_tool.pdfkit, "from_file", from_file)
+    monkeypatch.setattr(invoice_tool.pdfkit, "from_string", from_string)
+
+@pytest.mark.parametrize("combined", [False, True])
+def test_partial_invoice_output_is_not_cached(app_module, flaky_pdfkit, combined):
+    app = app_module
+    upload = open(fixtures.invoice_csv(5), "rb").read()
+    params = {"workers": 1, "combined": combined}
+    key = app.cache_key("invoice", [upload], params)
+    output_path = os.path.join(app.OUTPUT_FOLDER, f"partial_{combined}")
+    job_id = app.create_job(output_path, "invoices", False, status="queued")
+
+    app.run_job(job_id, app.run_invoice, [upload], output_path, None, key, params)
+
+    assert app.get_job(job_id)["status"] == "ready"
+    assert app.cache_lookup(key) is None
+
+def test_value_error_message_reaches_the_user(app_module, tmp_path):
+    app = app_module
+    path = tmp_path / "bad.csv"
+    path.write_text("Invoice_No,Invoice_Date\n1,2024-01-01\n")
+    output_path = os.path.join(app.OUTPUT_FOLDER, "bad.zip")
+    job_id = app.create_job(output_path, "invoices", False, status="queued")
+
+    app.run_job(job_id, app.run_invoice, [path.read_bytes()], output_path, None, None, {})
+
+    job = app.get_job(job_id)
+    assert job["status"] == "failed"
+    assert job["error"].startswith("Missing column(s): Customer_Name")
+
+def test_unreadable_input_keeps_generic_message(app_module):
+    app = app_module
+    output_path = os.path.join(app.OUTPUT_FOLDER, "empty.csv")
+    job_id = app.create_job(output_path, "cleaned.csv", False, status="queued")
+
+    app.run_job(job_id, app.run_csv_cleaner, [b""], output_path, None, None, {})
+
+    assert app.get_job(job_id)["error"] == app.JOB_ERRORS["run_csv_cleaner"]
+
+def test_combined_pdf_row_limit_is_checked_before_queueing(app_module):
+    app = app_module
+    client = app.app.test_client()
+    rows = invoice_tool.INVOICE_COMBINED_MAX_ROWS + 1
+    upload = open(fixtures.invoice_csv(rows), "rb").read()
+
+    response = client.post("/invoice", data={"file": (io.BytesIO(upload), "big.csv"), "output": "pdf"},
+                           headers={"X-Visitor-ID": "row-limit"})
+
+    assert response.status_code == 400
+    assert response.json["error"].startswith("Too many invoices for one PDF")
+    assert app.get_db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0] == 0
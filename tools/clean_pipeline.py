@@ -0,0 +1,422 @@
+"""
+Cleaning steps for clean_csv, chosen per run.
+
+A pipeline is a list of steps, each a name or a dict of the name plus options:
+
+    ["drop_empty_rows",
+     {"step": "drop_columns", "columns": ["Notes"]},
+     {"step": "collapse_whitespace"},
+     {"step": "coerce", "columns": ["Amount"], "to": "number"},
+     "dedupe",
+     "normalize_headers"]
+
+Pipeline plans it against the file's header, working out what has to run:
+
+- drop_columns with no whole-row step (drop_empty_rows, dedupe) before it
+  becomes the reader's usecols, so those columns are never parsed;
+- consecutive value steps (trim, collapse_whitespace, lowercase, coerce) are
+  fused into one pass that visits each column once;
+- drop_empty_rows runs ahead of value steps that can't empty a cell, so they
+  see fewer rows;
+- value steps a column already satisfies (a second trim, trimming a coerced
+  number) and steps left with no columns are skipped.
+
+Each step reports the rows it took in and kept and the seconds it took.
+"""
+
+import time
+from decimal import Decimal
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from tools.dedup import new_hash_key, row_fingerprints
+
+# What clean_csv did before steps could be chosen
+DEFAULT_STEPS = ["drop_empty_rows", "trim", "dedupe", "normalize_headers"]
+
+# step -> options it takes. Where "columns" is optional it defaults to all.
+STEP_OPTIONS = {
+    "drop_empty_rows": set(),
+    "drop_columns": {"columns"},
+    "trim": {"columns"},
+    "collapse_whitespace": {"columns"},
+    "lowercase": {"columns"},
+    "coerce": {"columns", "to", "dayfirst"},
+    "dedupe": {"exact"},
+    "normalize_headers": set(),
+}
+REQUIRED_OPTIONS = {
+    "drop_columns": {"columns"},
+    "coerce": {"columns", "to"},
+}
+COERCE_TYPES = ("number", "date")
+
+# What a column is known to satisfy after each value step, so repeating the
+# step is skipped. Coerced values are canonical: no spaces, no capitals.
+VALUE_RESULTS = {
+    "trim": {"trim"},
+    "collapse_whitespace": {"collapse_whitespace"},
+    "lowercase": {"lowercase"},
+    "coerce_number": {"coerce_number", "trim", "collapse_whitespace", "lowercase"},
+    "coerce_date": {"coerce_date", "trim", "collapse_whitespace", "lowercase"},
+}
+
+def normalize_header(name):
+    return name.strip().lower().replace(" ", "_")
+
+def normalize_headers(columns):
+    return (
+        columns
+        .str.strip()
+        .str.lower()
+        .str.replace(" ", "_")
+    )
+
+def parse_steps(steps):
+    """
+    Checks a pipeline and returns it as a list of {"step": name, **options}.
+    Raises ValueError describing the first problem.
+    """
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Steps must be a non-empty list")
+
+    parsed = []
+    for number, step in enumerate(steps, start=1):
+        if isinstance(step, str):
+            step = {"step": step}
+        name = step.get("step") if isinstance(step, dict) else None
+        if not isinstance(name, str) or name not in STEP_OPTIONS:
+            raise ValueError(f"Step {number}: unknown step. Choose from {', '.join(STEP_OPTIONS)}")
+
+        options = {key: value for key, value in step.items() if key != "step"}
+        unknown = set(options) - STEP_OPTIONS[name]
+        if unknown:
+            raise ValueError(f"Step {number} ({name}): unknown option {', '.join(sorted(unknown))}")
+        missing = REQUIRED_OPTIONS.get(name, set()) - set(options)
+        if missing:
+            raise ValueError(f"Step {number} ({name}): missing {', '.join(sorted(missing))}")
+
+        columns = options.get("columns")
+        if columns is not None and not (
+            isinstance(columns, list) and columns and all(isinstance(c, str) for c in columns)
+        ):
+            raise ValueError(f"Step {number} ({name}): columns must be a list of column names")
+        if name == "coerce" and options["to"] not in COERCE_TYPES:
+            raise ValueError(f"Step {number} (coerce): to must be one of {', '.join(COERCE_TYPES)}")
+        for flag in ("exact", "dayfirst"):
+            if flag in options and not isinstance(options[flag], bool):
+                raise ValueError(f"Step {number} ({name}): {flag} must be true or false")
+
+        parsed.append(dict(options, step=name))
+
+    if sum(step["step"] == "dedupe" for step in parsed) > 1:
+        raise ValueError("Only one dedupe step is allowed")
+    return parsed
+
+# ---------------- VALUE STEPS ----------------
+# Each takes and returns one text column; missing values stay missing.
+
+def _trim(values, step):
+    return values.str.strip()
+
+def _collapse_whitespace(values, step):
+    return values.str.replace(r"\s+", " ", regex=True)
+
+def _lowercase(values, step):
+    return values.str.lower()
+
+NUMBER_PATTERN = r"^[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?$"
+
+def _expand_exponent(value):
+    """"2.5E-3" -> "0.0025"; None past float range, where writing it out gets absurd."""
+    number = Decimal(value)
+    if not number:
+        return "0"
+    if abs(number.adjusted()) > 308:
+        return None
+    return format(number, "f")
+
+def _canonical_numbers(text):
+    """
+    Decimal numbers (an Arrow string array) rewritten exactly, without a
+    float in between: no "+", leading zeros or trailing fractional zeros
+    ("+007.50" -> "7.5") and exponents written out, so every copy of a
+    value comes out the same whatever else is in its chunk. Anything else
+    becomes missing.
+    """
+    valid = pc.match_substring_regex(text, NUMBER_PATTERN)
+    text = pc.if_else(valid, text, pa.scalar(None, pa.string()))
+    negative = pc.starts_with(text, "-")
+    digits = pc.replace_substring_regex(text, r"^[+-]", "")
+
+    exponent = pc.fill_null(pc.match_substring_regex(digits, "[eE]"), False)
+    if pc.any(exponent).as_py():
+        # rare enough to expand one at a time
+        expanded = [_expand_exponent(value) if value is not None else None
+                    for value in pc.if_else(exponent, digits, pa.scalar(None, pa.string())).to_pylist()]
+        digits = pc.if_else(exponent, pa.array(expanded, pa.string()), digits)
+
+    digits = pc.replace_substring_regex(digits, r"(\.[0-9]*?)0+$", r"\1")
+    digits = pc.replace_substring_regex(digits, r"\.$", "")
+    digits = pc.replace_substring_regex(digits, r"^0+([0-9])", r"\1")
+    digits = pc.replace_substring_regex(digits, r"^\.", "0.")
+    negative = pc.and_(negative, pc.not_equal(digits, "0"))
+    return pc.if_else(negative, pc.binary_join_element_wise("-", digits, ""), digits)
+
+def _coerce(values, step):
+    """
+    Rewrites values in canonical form: numbers without thousands separators
+    ("1,234.50" -> "1234.5"), dates as YYYY-MM-DD. Values that don't parse
+    become missing.
+    """
+    if step["to"] == "number":
+        text = pa.array(values.str.replace(",", "", regex=False).str.strip(), type=pa.string(),
+                        from_pandas=True)
+        text = _canonical_numbers(text)
+        return pd.Series(pd.arrays.ArrowStringArray(text), index=values.index, name=values.name)
+
+    # ISO dates first: fast, and never read day-first, so coercing twice is harmless
+    dates = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    rest = dates.isna() & values.notna()
+    if rest.any():
+        dates[rest] = pd.to_datetime(values[rest], errors="coerce", format="mixed",
+                                     dayfirst=step.get("dayfirst", False))
+    return dates.dt.strftime("%Y-%m-%d").astype(values.dtype)
+
+VALUE_FUNCTIONS = {
+    "trim": _trim,
+    "collapse_whitespace": _collapse_whitespace,
+    "lowercase": _lowercase,
+    "coerce": _coerce,
+}
+
+# ---------------- PIPELINE ----------------
+
+class Pipeline:
+    """
+    A pipeline planned against one file's header (see the module docstring).
+
+    Planned work is split at the dedupe step: before_dedupe() runs the steps
+    up to it and fingerprints the rows, keep_mask() drops duplicates, and
+    after_dedupe() runs the rest. Counts go into a stats list from
+    new_stats() that the caller keeps, so the plan itself can be sent to pool
+    workers and their stats added back with merge_stats().
+    """
+
+    def __init__(self, steps, columns, exact_dedup=False):
+        self.steps = parse_steps(steps)
+        self.usecols = None        # None reads every column
+        self.before = []           # ops up to the dedupe step
+        self.after = []            # ops after it
+        self.dedupe = None         # (step index, exact)
+        self.rename = False
+        # one key per file, sent to pool workers with the plan (see tools.dedup)
+        self.hash_key = new_hash_key()
+        # per step: "ran", "fused", "at_read", "skipped" or "header"
+        self.plan = ["ran"] * len(self.steps)
+        self._plan(list(columns), exact_dedup)
+
+    @staticmethod
+    def _resolve(names, columns):
+        """Header columns for `names`, given as written or as normalize_headers() would write them."""
+        normalized = {normalize_header(col): col for col in columns}
+        resolved, unknown = [], []
+        for name in names:
+            col = name if name in columns else normalized.get(normalize_header(name))
+            if col is None:
+                unknown.append(name)
+            elif col not in resolved:
+                resolved.append(col)
+        if unknown:
+            raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+        return resolved
+
+    def _plan(self, columns, exact_dedup):
+        live = list(columns)
+        at_read = set()
+        whole_rows_seen = False
+        no_empty_rows = False
+        satisfied = {col: set() for col in columns}
+        ops = self.before
+
+        for i, step in enumerate(self.steps):
+            name = step["step"]
+
+            if name == "drop_columns":
+                dropped = [col for col in self._resolve(step["columns"], columns) if col in live]
+                live = [col for col in live if col not in dropped]
+                if not whole_rows_seen:
+                    # no earlier step looked at these columns' rows
+                    at_read.update(dropped)
+                    self.plan[i] = "at_read"
+                elif not dropped:
+                    self.plan[i] = "skipped"
+                else:
+                    ops.append(("drop_columns", i, dropped))
+                    no_empty_rows = False
+
+            elif name == "drop_empty_rows":
+                whole_rows_seen = True
+                if no_empty_rows:
+                    self.plan[i] = "skipped"
+                    continue
+                no_empty_rows = True
+                if ops and ops[-1][0] == "values" and all(s[1] != "coerce" for s in ops[-1][1]):
+                    # only coerce can empty a cell, so filter before the pass
+                    ops.insert(len(ops) - 1, ("drop_empty_rows", i))
+                else:
+                    ops.append(("drop_empty_rows", i))
+
+            elif name == "dedupe":
+                whole_rows_seen = True
+                self.dedupe = (i, step.get("exact", exact_dedup))
+                ops = self.after
+
+            elif name == "normalize_headers":
+                self.rename = True
+                self.plan[i] = "header"
+
+            else:
+                targets = live if step.get("columns") is None else [
+                    col for col in self._resolve(step["columns"], columns) if col in live
+                ]
+                result = "coerce_" + step["to"] if name == "coerce" else name
+                targets = [col for col in targets if result not in satisfied[col]]
+                if not targets:
+                    self.plan[i] = "skipped"
+                    continue
+                for col in targets:
+                    if name == "coerce":
+                        satisfied[col] = set(VALUE_RESULTS[result])
+                    else:
+                        satisfied[col] |= VALUE_RESULTS[result]
+                if name == "coerce":
+                    no_empty_rows = False
+
+                if ops and ops[-1][0] == "values":
+                    ops[-1][1].append((i, name, step, targets))
+                else:
+                    ops.append(("values", [(i, name, step, targets)]))
+
+        if at_read:
+            self.usecols = [col for col in columns if col not in at_read]
+            self._skip_columns(at_read)
+
+        for ops in (self.before, self.after):
+            for op in ops:
+                if op[0] == "values" and len(op[1]) > 1:
+                    for i, *_ in op[1]:
+                        self.plan[i] = "fused"
+
+    def _skip_columns(self, dropped):
+        """Takes columns dropped at read out of the value steps planned before the drop."""
+        for op in self.before:
+            if op[0] != "values":
+                continue
+            group = []
+            for i, name, step, targets in op[1]:
+                targets = [col for col in targets if col not in dropped]
+                if targets:
+                    group.append((i, name, step, targets))
+                else:
+                    self.plan[i] = "skipped"
+            op[1][:] = group
+        self.before[:] = [op for op in self.before if op[0] != "values" or op[1]]
+
+    # ---- running ----
+
+    def new_stats(self):
+        """Per step: [rows in, rows out, seconds]."""
+        return [[0, 0, 0.0] for _ in self.steps]
+
+    @staticmethod
+    def merge_stats(stats, more):
+        for total, part in zip(stats, more):
+            total[0] += part[0]
+            total[1] += part[1]
+            total[2] += part[2]
+
+    def _run(self, df, ops, stats):
+        for op in ops:
+            start = time.perf_counter()
+            rows = len(df)
+            if op[0] == "values":
+                df = self._run_values(df, op[1], stats)
+                continue
+            if op[0] == "drop_empty_rows":
+                df = df.dropna(how="all")
+            else:
+                df = df.drop(columns=op[2])
+            counts = stats[op[1]]
+            counts[0] += rows
+            counts[1] += len(df)
+            counts[2] += time.perf_counter() - start
+        return df
+
+    def _run_values(self, df, group, stats):
+        """One fused pass: every column goes through its steps of the group, in order."""
+        chains = {}
+        for i, name, step, targets in group:
+            for col in targets:
+                chains.setdefault(col, []).append((i, VALUE_FUNCTIONS[name], step))
+            stats[i][0] += len(df)
+            stats[i][1] += len(df)
+
+        if not len(df):
+            return df
+        columns = {}
+        for col in df.columns:
+            values = df[col]
+            for i, function, step in chains.get(col, ()):
+                start = time.perf_counter()
+                values = function(values, step)
+                stats[i][2] += time.perf_counter() - start
+            columns[col] = values
+        return pd.DataFrame(columns, index=df.index)
+
+    def before_dedupe(self, df, stats):
+        """Runs the steps up to dedupe. Returns (rows, fingerprints or None)."""
+        df = self._run(df, self.before, stats)
+        if self.dedupe is None:
+            return df, None
+        start = time.perf_counter()
+        fingerprints = row_fingerprints(df, self.hash_key)
+        stats[self.dedupe[0]][2] += time.perf_counter() - start
+        return df, fingerprints
+
+    def keep_mask(self, duplicates, df, fingerprints, stats):
+        """
+        duplicates.keep_mask() for the dedupe step, or None (keep every row)
+        without one. `duplicates` must use this pipeline's hash_key; `df` is
+        only needed for exact dedupe.
+        """
+        if self.dedupe is None:
+            return None
+        start = time.perf_counter()
+        keep = duplicates.keep_mask(df, fingerprints)
+        counts = stats[self.dedupe[0]]
+        counts[0] += len(keep)
+        counts[1] += int(keep.sum())
+        counts[2] += time.perf_counter() - start
+        return keep
+
+    def after_dedupe(self, df, stats):
+        return self._run(df, self.after, stats)
+
+    def output_columns(self, columns):
+        return normalize_headers(columns) if self.rename else columns
+
+    def report(self, stats):
+        """One dict per step, in pipeline order."""
+        return [
+            {
+                "step": step["step"],
+                "plan": plan,
+                "rows_in": counts[0],
+                "rows_out": counts[1],
+                "seconds": counts[2],
+            }
+            for step, plan, counts in zip(self.steps, self.plan, stats)
+        ]
@@ -1,30 +1,310 @@
 import pandas as pd
+import numpy as np
 import os
+import io
+import csv
+from tools import metrics
+from tools.clean_pipeline import DEFAULT_STEPS, Pipeline
+from tools.dedup import DuplicateFilter
+from tools.metrics import stage
+from tools.streaming import imap_ordered, open_binary
+from tools.table_output import OUTPUT_FORMATS, open_writer
 
-def clean_csv(input_csv, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
+# Rows cleaned at a time. Memory is bounded by one chunk plus one 64-bit
+# fingerprint per distinct row seen so far, instead of several copies of the
+# whole file. None reads the file in one piece.
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", 50000))
+
+# Processes used by parallel mode (workers > 1), and the size of the byte
+# range each one cleans at a time.
+CSV_WORKERS = int(os.environ.get("CSV_WORKERS", os.cpu_count() or 1))
+CSV_PART_BYTES = int(os.environ.get("CSV_PART_BYTES", 8 * 1024 * 1024))
+
+# Arrow-backed strings: a fraction of the memory of Python str objects, and
+# trimming runs in Arrow's compute kernels instead of a Python loop.
+STRING_DTYPE = "string[pyarrow]"
+
+# Every column is read as text: types inferred per chunk could disagree
+# between chunks, and the cleaner shouldn't rewrite numbers anyway. Only
+# empty cells are missing; "NA", "null" or "nan" are kept as written.
+READ_OPTIONS = dict(dtype=STRING_DTYPE, keep_default_na=False, na_values=[""])
+
+def _read_header(handle):
+    """Column names, leaving the handle where it was."""
+    pos = handle.tell()
+    columns = pd.read_csv(handle, nrows=0, **READ_OPTIONS).columns
+    handle.seek(pos)
+    return columns
+
+def read_header(input_csv):
+    """Column names of a CSV path or binary file object."""
+    handle, _, opened = open_binary(input_csv)
+    try:
+        return _read_header(handle)
+    finally:
+        if opened:
+            handle.close()
+
+def _read_chunks(handle, chunk_rows, usecols=None):
+    if not chunk_rows:
+        yield pd.read_csv(handle, usecols=usecols, **READ_OPTIONS)
+        return
+    with pd.read_csv(handle, chunksize=chunk_rows, usecols=usecols, **READ_OPTIONS) as reader:
+        yield from reader
+
+def clean_chunk(df, pipeline, duplicates, stats):
+    """
+    Runs `pipeline` over one chunk. `duplicates` is the DuplicateFilter
+    shared by every chunk of the file, so rows already kept from earlier
+    chunks are dropped.
+    """
+    df, fingerprints = pipeline.before_dedupe(df, stats)
+    keep = pipeline.keep_mask(duplicates, df, fingerprints, stats)
+    if keep is not None:
+        df = df[keep]
+    df = pipeline.after_dedupe(df, stats)
+    df.columns = pipeline.output_columns(df.columns)
+    return df
+
+# ---------------- PARALLEL ----------------
+# The file is cut into byte ranges that each hold whole records. Workers parse
+# and clean their range, fingerprint the rows and (for CSV output) render them;
+# the parent takes the parts back in file order, drops duplicates against
+# everything before and writes.
+
+def _record_end(f, pos, quoted):
+    """
+    Offset just past the first record separator at or after `pos`. A newline
+    only ends a record outside quotes; `quoted` says whether `pos` is inside
+    a quoted field. Escaped quotes ("") flip the state twice.
+    """
+    f.seek(pos)
+    while True:
+        block = f.read(64 * 1024)
+        if not block:
+            return pos
+        i = 0
+        while True:
+            newline = block.find(b"\n", i)
+            if newline < 0:
+                quoted ^= block.count(b'"', i) % 2 == 1
+                break
+            quoted ^= block.count(b'"', i, newline) % 2 == 1
+            if not quoted:
+                return pos + newline + 1
+            i = newline + 1
+        pos += len(block)
+
+def _quoted_at(f, start, end):
+    """Whether offset `end` is inside a quoted field, given `start` is a record boundary."""
+    f.seek(start)
+    quotes = 0
+    while start < end:
+        block = f.read(min(1024 * 1024, end - start))
+        if not block:
+            break
+        quotes += block.count(b'"')
+        start += len(block)
+    return quotes % 2 == 1
+
+def record_ranges(path, part_bytes=CSV_PART_BYTES):
+    """Returns (header length, [(start, end)]) with every range made of whole records."""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        header_end = _record_end(f, 0, False)
+        start = header_end
+        while start < size:
+            target = start + part_bytes
+            end = size if target >= size else _record_end(f, target, _quoted_at(f, start, target))
+            ranges.append((start, end))
+            start = end
+    return header_end, ranges
+
+def render_csv_rows(df):
+    """
+    The rows as pandas' to_csv(header=False) would write them, plus each
+    row's length in characters so the parent can cut duplicates out.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    lengths = np.fromiter((writer.writerow(row) for row in rows), dtype=np.int64, count=len(df))
+    return buffer.getvalue(), lengths
+
+def _kept_text(text, lengths, keep):
+    if keep.all():
+        return text
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    # each run of consecutive kept rows is one slice
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], keep.astype(np.int8), [0]))))
+    return "".join(text[starts[a]:ends[b - 1]] for a, b in zip(edges[::2], edges[1::2]))
 
-    df = pd.read_csv(input_csv)
+def _clean_part(path, header_end, start, end, render, pipeline):
+    """
+    Runs in a pool worker. The whole pipeline runs here, steps after dedupe
+    included, so duplicates are only cut out afterwards: returns (rows,
+    fingerprints, rows as dedupe saw them (exact mode only), position of each
+    row in those, rendered CSV text, row lengths, step stats).
+    """
+    with open(path, "rb") as f:
+        header = f.read(header_end)
+        f.seek(start)
+        data = f.read(end - start)
 
-    # remove completely empty rows
-    df = df.dropna(how="all")
+    stats = pipeline.new_stats()
+    df = pd.read_csv(io.BytesIO(header + data), usecols=pipeline.usecols, **READ_OPTIONS)
+    deduped, fingerprints = pipeline.before_dedupe(df, stats)
+    df = pipeline.after_dedupe(deduped, stats)
+    positions = deduped.index.get_indexer(df.index)
+    exact_rows = deduped if pipeline.dedupe and pipeline.dedupe[1] else None
+    text, lengths = render_csv_rows(df) if render else (None, None)
+    return df, fingerprints, exact_rows, positions, text, lengths, stats
 
-    # trim spaces from string columns
-    for col in df.select_dtypes(include=["object"]).columns:
-        df[col] = df[col].astype(str).str.strip()
+def _clean_parallel(path, workers, render, part_bytes, pipeline):
+    """
+    Yields _clean_part() results plus the byte offset reached, in file order
+    (see tools.streaming.imap_ordered).
+    """
+    header_end, ranges = record_ranges(path, part_bytes)
+    if not ranges:
+        # header only
+        yield _clean_part(path, header_end, header_end, header_end, render, pipeline) + (header_end,)
+        return
+
+    args = ((path, header_end, start, end, render, pipeline) for start, end in ranges)
+    parts = imap_ordered(_clean_part, args, workers)
+    try:
+        for (_, end), part in zip(ranges, parts):
+            yield part + (end,)
+    finally:
+        parts.close()
+
+def _write_parallel(path, total_bytes, writer, pipeline, duplicates, stats, output_format, workers,
+                    progress, part_bytes):
+    render = output_format.startswith("csv")
+    header_written = False
+    parts = _clean_parallel(path, workers, render, part_bytes, pipeline)
+    for df, fingerprints, exact_rows, positions, text, lengths, part_stats, end in parts:
+        Pipeline.merge_stats(stats, part_stats)
+        with stage("csv_cleaner", "clean"):
+            keep = pipeline.keep_mask(duplicates, exact_rows, fingerprints, stats)
+            if keep is not None:
+                # rows dropped after dedupe are missing from `positions`
+                keep = keep[positions]
+            df.columns = pipeline.output_columns(df.columns)
+
+        with stage("csv_cleaner", "write_csv" if render else "write_" + output_format):
+            if render:
+                if not header_written:
+                    writer.write(df.iloc[:0])
+                    header_written = True
+                writer.write_text(text if keep is None else _kept_text(text, lengths, keep))
+            else:
+                writer.write(df if keep is None else df[keep])
+
+        if progress:
+            progress(end, total_bytes)
+
+# ---------------- CLEAN ----------------
+
+def _write_sequential(chunks, handle, total_bytes, writer, pipeline, duplicates, stats, write_stage,
+                      progress):
+    while True:
+        with stage("csv_cleaner", "read_csv"):
+            df = next(chunks, None)
+        if df is None:
+            break
+
+        with stage("csv_cleaner", "clean"):
+            df = clean_chunk(df, pipeline, duplicates, stats)
+
+        with stage("csv_cleaner", write_stage):
+            writer.write(df)
+
+        if progress and total_bytes:
+            progress(handle.tell(), total_bytes)
+
+def record_steps(report):
+    """Adds a clean_csv report to the per-step metrics."""
+    for entry in report:
+        if entry["plan"] in ("ran", "fused"):
+            metrics.observe("stage_duration_seconds", entry["seconds"],
+                            tool="csv_cleaner", stage="step_" + entry["step"])
+            metrics.inc("csv_rows_removed_total", entry["rows_in"] - entry["rows_out"],
+                        step=entry["step"])
+
+def clean_csv(input_csv, output_dir, progress=None, chunk_rows=CSV_CHUNK_ROWS, exact_dedup=False,
+              output_format="csv", workers=1, part_bytes=CSV_PART_BYTES, steps=None, report=None):
+    """
+    Cleans the CSV with `steps` (see tools.clean_pipeline; by default drop
+    empty rows, trim, dedupe and normalize headers), streaming `chunk_rows`
+    rows at a time into cleaned.<ext>. Duplicates are removed across the
+    whole file, keeping the first copy; exact_dedup confirms each match
+    against the stored row (see tools.dedup) unless the dedupe step says
+    otherwise. output_format is a key of OUTPUT_FORMATS (see
+    tools.table_output).
+
+    With workers > 1 and a file path as input, byte ranges of `part_bytes`
+    are cleaned across a process pool instead; the output is the same, but
+    steps after dedupe also count the duplicate rows they processed. Files
+    the ranges can't be cut from reliably fall back to sequential cleaning.
+
+    If `report` is a list, one dict per step is appended to it: rows in,
+    rows out, seconds and how the step was planned.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, "cleaned" + OUTPUT_FORMATS[output_format])
+    write_stage = "write_csv" if output_format.startswith("csv") else "write_" + output_format
 
-    # remove duplicate rows
-    df = df.drop_duplicates()
+    handle, total_bytes, opened = open_binary(input_csv)
+    duplicates = None
+    chunks = None
+    try:
+        pipeline = Pipeline(steps or DEFAULT_STEPS, _read_header(handle), exact_dedup)
+        stats = pipeline.new_stats()
+        duplicates = DuplicateFilter(exact=bool(pipeline.dedupe and pipeline.dedupe[1]),
+                                     hash_key=pipeline.hash_key)
+        writer = open_writer(output_path, output_format)
 
-    # normalize headers
-    df.columns = (
-        df.columns
-        .str.strip()
-        .str.lower()
-        .str.replace(" ", "_")
-    )
+        if workers > 1 and opened:
+            try:
+                _write_parallel(input_csv, total_bytes, writer, pipeline, duplicates, stats,
+                                output_format, workers, progress, part_bytes)
+            except pd.errors.ParserError as e:
+                # Ranges are cut by quote parity, which a literal " inside an
+                # unquoted field (5" screen) throws off when the file also has
+                # multi-line quoted fields. Start over in one piece.
+                print(f"Parallel CSV cleaning failed ({e}); cleaning sequentially")
+                metrics.inc("csv_parallel_fallbacks_total")
+                writer.abort()
+                duplicates.close()
+                stats = pipeline.new_stats()
+                duplicates = DuplicateFilter(exact=duplicates.exact, hash_key=pipeline.hash_key)
+                writer = open_writer(output_path, output_format)
+                handle.seek(0)
+                chunks = _read_chunks(handle, chunk_rows, pipeline.usecols)
+                _write_sequential(chunks, handle, total_bytes, writer, pipeline, duplicates, stats,
+                                  write_stage, progress)
+        else:
+            chunks = _read_chunks(handle, chunk_rows, pipeline.usecols)
+            _write_sequential(chunks, handle, total_bytes, writer, pipeline, duplicates, stats,
+                              write_stage, progress)
 
-    output_path = os.path.join(output_dir, "cleaned.csv")
-    df.to_csv(output_path, index=False)
+        # Typed formats do their conversion and the real write here
+        with stage("csv_cleaner", write_stage):
+            writer.close()
+    finally:
+        if duplicates is not None:
+            duplicates.close()
+        if chunks is not None:
+            chunks.close()
+        if opened:
+            handle.close()
 
+    steps_report = pipeline.report(stats)
+    record_steps(steps_report)
+    if report is not None:
+        report.extend(steps_report)
     return output_path
@@ -0,0 +1,142 @@
+"""
+Duplicate-row detection for data read in chunks.
+
+Every row is reduced to a 64-bit fingerprint, and the fingerprints of kept
+rows are stored in a few sorted numpy arrays: 8 bytes per distinct row,
+however wide the rows are. A row whose fingerprint was seen before is a
+duplicate.
+
+Fingerprints are pandas' SipHash of the cells under a random key chosen per
+file (new_hash_key), so which rows collide can't be predicted from the data
+or engineered into an upload. Two different rows can still share a
+fingerprint by chance, which drops one of them. In exact mode every kept row
+is also appended to a temporary spill file, and a fingerprint match only
+counts once the stored row is read back and compared. Rows that merely
+collide are kept.
+"""
+
+import secrets
+import struct
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.util import hash_pandas_object
+
+def new_hash_key():
+    """A random SipHash key (16 characters) for one file's fingerprints."""
+    return secrets.token_hex(8)
+
+def row_fingerprints(df, hash_key):
+    """
+    One uint64 per row. Equal rows get equal fingerprints in any chunk or
+    process as long as they share `hash_key`; each column hashes only its
+    distinct values.
+    """
+    return hash_pandas_object(df, index=False, hash_key=hash_key, categorize=True).to_numpy()
+
+def _encode_rows(df):
+    # repr() of a tuple of str/None is unambiguous, so equal bytes mean equal rows
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    return [repr(row).encode("utf-8") for row in rows]
+
+class DuplicateFilter:
+    """
+    Remembers the rows it has kept across calls to keep_mask(), so that
+    duplicate rows are found even when the copies are in different chunks.
+    """
+
+    def __init__(self, exact=False, hash_key=None):
+        self.exact = exact
+        # fingerprints passed to keep_mask() must use the same key
+        self.hash_key = hash_key or new_hash_key()
+        # Sorted (fingerprints, spill offsets or None) runs, largest first;
+        # merged like a binary counter so there are only log2(rows) of them.
+        self._runs = []
+        self._spill = tempfile.TemporaryFile(prefix="dedup_") if exact else None
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self._runs)
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keep_mask(self, df, fingerprints=None):
+        """
+        Boolean array: True for rows of `df` that are not copies of an
+        earlier row in `df` or of any row kept by a previous call. The rows
+        marked True are remembered. `fingerprints` may be passed in when
+        row_fingerprints(df, self.hash_key) was already computed (e.g. in
+        another process); `df` is then only needed in exact mode.
+        """
+        if fingerprints is None:
+            fingerprints = row_fingerprints(df, self.hash_key)
+        if self.exact:
+            keep = ~df.duplicated().to_numpy()
+        else:
+            keep = ~pd.Index(fingerprints).duplicated()
+
+        seen = keep & self._contains(fingerprints)
+        if self.exact and seen.any():
+            candidates = np.flatnonzero(seen)
+            for i, row in zip(candidates, _encode_rows(df.iloc[candidates])):
+                if not self._stored(fingerprints[i], row):
+                    seen[i] = False
+
+        keep &= ~seen
+        self._add(fingerprints[keep], df[keep] if self.exact else None)
+        return keep
+
+    def _contains(self, fingerprints):
+        found = np.zeros(len(fingerprints), dtype=bool)
+        for keys, _ in self._runs:
+            idx = np.minimum(np.searchsorted(keys, fingerprints), len(keys) - 1)
+            found |= keys[idx] == fingerprints
+        return found
+
+    def _stored(self, fingerprint, row):
+        """Whether `row` (encoded) was kept before under `fingerprint`."""
+        for keys, offsets in self._runs:
+            lo = np.searchsorted(keys, fingerprint, side="left")
+            hi = np.searchsorted(keys, fingerprint, side="right")
+            for offset in offsets[lo:hi]:
+                self._spill.seek(int(offset))
+                (size,) = struct.unpack("<I", self._spill.read(4))
+                if self._spill.read(size) == row:
+                    return True
+        return False
+
+    def _add(self, fingerprints, rows):
+        if not len(fingerprints):
+            return
+
+        offsets = None
+        if self.exact:
+            self._spill.seek(0, 2)
+            offsets = np.empty(len(fingerprints), dtype=np.uint64)
+            for i, row in enumerate(_encode_rows(rows)):
+                offsets[i] = self._spill.tell()
+                self._spill.write(struct.pack("<I", len(row)) + row)
+
+        run = self._sorted(fingerprints, offsets)
+        while self._runs and len(self._runs[-1][0]) <= len(run[0]):
+            keys, more_offsets = self._runs.pop()
+            run = self._sorted(
+                np.concatenate([keys, run[0]]),
+                None if offsets is None else np.concatenate([more_offsets, run[1]]),
+            )
+        self._runs.append(run)
+
+    @staticmethod
+    def _sorted(keys, offsets):
+        if offsets is None:
+            return np.sort(keys), None
+        order = np.argsort(keys, kind="stable")
+        return keys[order], offsets[order]
@@ -2,41 +2,355 @@ import pandas as pd
 from jinja2 import Environment, FileSystemLoader
 import pdfkit
 import os
+from functools import lru_cache
+from collections import deque
+import io
+import tempfile
+import time
+from pypdf import PdfReader, PdfWriter
+from tools import metrics
+from tools.metrics import stage
+from tools.streaming import imap_ordered, open_binary
 
-def generate_invoices(csv_path, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
+# Invoices rendered per wkhtmltopdf process. Process startup dominated the
+# per-row cost, so each batch is rendered in one call and split back into one
+# PDF per invoice. 1 renders every row separately (the old behaviour).
+INVOICE_BATCH_SIZE = int(os.environ.get("INVOICE_BATCH_SIZE", 50))
+
+# Rows read from the CSV at a time; keeps memory flat for very large uploads.
+INVOICE_CHUNK_ROWS = int(os.environ.get("INVOICE_CHUNK_ROWS", 5000))
+
+# Processes used by parallel mode (workers > 1). Batches are spread across
+# them; output order and filenames are the same as in sequential mode.
+INVOICE_WORKERS = int(os.environ.get("INVOICE_WORKERS", os.cpu_count() or 1))
+
+# The combined PDF is assembled in memory until it's written, so it takes at
+# most this many invoices; larger uploads use the zip output.
+INVOICE_COMBINED_MAX_ROWS = int(os.environ.get("INVOICE_COMBINED_MAX_ROWS", 20000))
+
+PDFKIT_OPTIONS = {"quiet": ""}
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+NUMERIC_COLUMNS = ["Quantity", "Rate", "GST_Percent"]
+REQUIRED_COLUMNS = ["Invoice_No", "Invoice_Date", "Customer_Name", "Customer_Address",
+                    "Service_Name"] + NUMERIC_COLUMNS
+
+# CSV column -> invoice.html variable
+TEMPLATE_FIELDS = {
+    "Invoice_No": "invoice_no",
+    "Invoice_Date": "invoice_date",
+    "Customer_Name": "customer_name",
+    "Customer_Address": "customer_address",
+    "Service_Name": "service_name",
+    "Quantity": "quantity",
+    "Rate": "rate",
+    "amount": "amount",
+    "GST_Percent": "gst_percent",
+    "gst_amount": "gst_amount",
+    "total": "total",
+}
+
+@lru_cache(maxsize=None)
+def get_invoice_template():
+    """Compiled once per process; templates don't change while the app runs."""
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR), auto_reload=False)
+    return env.get_template("invoice.html")
+
+def prepare_invoices(df):
+    """
+    Validates the upload and computes the money columns for every row at
+    once. Returns one dict of template variables per invoice.
+    """
+    missing = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+
+    df = df[REQUIRED_COLUMNS].copy()
+    for col in NUMERIC_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+
+    bad = df[NUMERIC_COLUMNS].isna().any(axis=1)
+    if bad.any():
+        # +2: header line and 1-based numbering, to match what users see in Excel
+        rows = ", ".join(str(i + 2) for i in df.index[bad][:10])
+        raise ValueError(f"Quantity, Rate and GST_Percent must be numbers (check row(s) {rows})")
+
+    df["amount"] = df["Quantity"] * df["Rate"]
+    df["gst_amount"] = df["amount"] * df["GST_Percent"] / 100
+    df["total"] = df["amount"] + df["gst_amount"]
+
+    return df.rename(columns=TEMPLATE_FIELDS).to_dict("records")
+
+def invoice_filename(invoice_no):
+    return f"invoice_{invoice_no}.pdf"
+
+def _render_batch(html_docs, split=True):
+    """
+    Renders several single-page invoices with one wkhtmltopdf call. Each
+    input document starts on a new page, so page i belongs to invoice i.
+    Returns a list of PDF bytes (one per invoice, or just the batch PDF when
+    split=False), or None if the page count doesn't line up (e.g. an invoice
+    overflowed onto a second page).
+    """
+    with tempfile.TemporaryDirectory(prefix="invoices_") as tmp:
+        paths = []
+        for i, html in enumerate(html_docs):
+            path = os.path.join(tmp, f"{i:05d}.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(html)
+            paths.append(path)
+
+        combined = pdfkit.from_file(paths, False, options=PDFKIT_OPTIONS)
+
+    reader = PdfReader(io.BytesIO(combined))
+    if len(reader.pages) != len(html_docs):
+        return None
+    if not split:
+        return [combined]
+
+    pdfs = []
+    for page in reader.pages:
+        writer = PdfWriter()
+        writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        pdfs.append(buffer.getvalue())
+    return pdfs
+
+def _render_one(html):
+    """Returns (pdf_bytes, None) or (None, error message)."""
+    try:
+        # output_path=False makes pdfkit return the PDF bytes
+        return pdfkit.from_string(html, False, options=PDFKIT_OPTIONS), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+def _render(html_docs, combined=False):
+    """
+    Renders a batch to [(invoice_count, pdf_bytes, error)], each PDF covering
+    the next invoice_count documents. That is one entry per invoice, or with
+    combined=True a single entry for the whole batch when it renders in one
+    piece. A failing batch is retried one invoice at a time to isolate the bad row.
+    """
+    results = None
+    if len(html_docs) > 1:
+        try:
+            pdfs = _render_batch(html_docs, split=not combined)
+            if pdfs is not None:
+                count = len(html_docs) if combined else 1
+                results = [(count, pdf, None) for pdf in pdfs]
+        except Exception:
+            results = None
+    if results is None:
+        results = [(1,) + _render_one(html) for html in html_docs]
+    return results
+
+def _render_records(records, combined=False):
+    """
+    Renders one batch of prepared records. Returns ([(invoice_nos, pdf_bytes,
+    error)] grouped as _render() returns them, [(stage, seconds)]). Runs in
+    pool workers too, so the timings are handed back for the caller to
+    record (see record_render).
+    """
+    template = get_invoice_template()
+    start = time.perf_counter()
+    html_docs = [template.render(**record) for record in records]
+    timings = [("render_html", time.perf_counter() - start)]
+
+    start = time.perf_counter()
+    rendered = _render(html_docs, combined)
+    per_invoice = (time.perf_counter() - start) / len(html_docs)
+    timings.extend(("render_pdf", per_invoice) for _ in html_docs)
 
-    df = pd.read_csv(csv_path)
+    invoice_nos = [record["invoice_no"] for record in records]
+    results = []
+    start = 0
+    for count, pdf_bytes, error in rendered:
+        results.append((invoice_nos[start:start + count], pdf_bytes, error))
+        start += count
+    return results, timings
 
-    env = Environment(loader=FileSystemLoader("templates"))
-    template = env.get_template("invoice.html")
+def record_render(timings):
+    for stage_name, seconds in timings:
+        metrics.observe("stage_duration_seconds", seconds, tool="invoice", stage=stage_name)
+
+def _render_parallel(batches, workers, combined=False):
+    """Yields batch results in submission order (see tools.streaming.imap_ordered)."""
+    return imap_ordered(_render_records, ((batch, combined) for batch in batches), workers)
+
+def _read_chunks(handle, chunk_rows):
+    if not chunk_rows:
+        yield pd.read_csv(handle)
+        return
+    with pd.read_csv(handle, chunksize=chunk_rows) as reader:
+        yield from reader
+
+def _iter_batches(handle, batch_size, chunk_rows, positions):
+    """
+    Reads the CSV chunk by chunk and yields render batches. The byte offset
+    reached when each batch was read is appended to `positions`, which the
+    consumer pops in the same order to report progress.
+    """
+    chunks = _read_chunks(handle, chunk_rows)
+    try:
+        while True:
+            with stage("invoice", "read_csv"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+
+            with stage("invoice", "prepare"):
+                records = prepare_invoices(chunk)
+
+            position = handle.tell()
+            for i in range(0, len(records), batch_size):
+                positions.append(position)
+                yield records[i:i + batch_size]
+    finally:
+        chunks.close()
+
+def _iter_rendered(csv_file, progress, batch_size, workers, failures, chunk_rows, combined=False):
+    """Yields (invoice_nos, pdf_bytes) as batches finish; see iter_invoices()."""
+    handle, total_bytes, opened = open_binary(csv_file)
+    batch_size = max(1, batch_size)
+    positions = deque()
+    batches = _iter_batches(handle, batch_size, chunk_rows, positions)
+    if workers > 1:
+        results = _render_parallel(batches, workers, combined)
+    else:
+        results = (_render_records(batch, combined) for batch in batches)
+
+    try:
+        rows = 0
+        failed = 0
+        for batch_results, timings in results:
+            record_render(timings)
+            for invoice_nos, pdf_bytes, error in batch_results:
+                rows += len(invoice_nos)
+                if error is None:
+                    yield invoice_nos, pdf_bytes
+                    continue
+                filename = invoice_filename(invoice_nos[0])
+                if failures is None:
+                    raise RuntimeError(f"Could not render {filename}: {error}")
+                failures.append((filename, error))
+                failed += 1
+
+            position = positions.popleft()
+            if progress and total_bytes:
+                progress(position, total_bytes)
+    finally:
+        # Stop the reader before its file goes away
+        results.close()
+        batches.close()
+        if opened:
+            handle.close()
+
+    if rows and failed == rows:
+        raise RuntimeError("No invoice could be rendered")
+
+def iter_invoices(csv_file, progress=None, batch_size=INVOICE_BATCH_SIZE, workers=1, failures=None,
+                  chunk_rows=INVOICE_CHUNK_ROWS):
+    """
+    Yields (filename, pdf_bytes) for each invoice row, without touching disk.
+
+    The CSV is read `chunk_rows` rows at a time (None reads it whole), so
+    memory stays flat however long the upload is; each PDF is yielded as soon
+    as its batch is rendered. With workers > 1 the batches are rendered
+    across a process pool.
+
+    If `failures` is a list, invoices that fail to render are appended to it
+    as (filename, error) and the rest of the batch carries on; otherwise the
+    first failure raises.
+    """
+    for (invoice_no,), pdf_bytes in _iter_rendered(csv_file, progress, batch_size, workers,
+                                                   failures, chunk_rows):
+        yield invoice_filename(invoice_no), pdf_bytes
+
+def _too_many_invoices(max_rows):
+    return f"Too many invoices for one PDF (the limit is {max_rows:,}); choose the zip output instead"
+
+def check_combined_rows(csv_file, max_rows=INVOICE_COMBINED_MAX_ROWS):
+    """
+    Raises ValueError if the CSV holds more than `max_rows` invoices for
+    generate_combined_invoice_pdf(), reading no further than the limit. A
+    file that doesn't parse is left for the render to report. File objects
+    are put back where they were.
+    """
+    handle, _, opened = open_binary(csv_file)
+    pos = handle.tell()
+    rows = 0
+    try:
+        with pd.read_csv(handle, usecols=[0], chunksize=INVOICE_CHUNK_ROWS) as reader:
+            for chunk in reader:
+                rows += len(chunk)
+                if rows > max_rows:
+                    raise ValueError(_too_many_invoices(max_rows))
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeError):
+        return
+    finally:
+        if opened:
+            handle.close()
+        else:
+            handle.seek(pos)
+
+def generate_combined_invoice_pdf(csv_file, output_path, progress=None, batch_size=INVOICE_BATCH_SIZE,
+                                  workers=1, failures=None, chunk_rows=INVOICE_CHUNK_ROWS,
+                                  max_rows=INVOICE_COMBINED_MAX_ROWS):
+    """
+    Writes every invoice into one PDF at `output_path`, one invoice per page
+    (more if an invoice overflows) with an outline entry per Invoice_No.
+
+    Batches are kept whole instead of being split per invoice, so pages
+    rendered together already share fonts and images; identical objects
+    from different batches are merged before writing. Rows that fail to
+    render are listed in an attached failed_invoices.txt, as in the zip.
+
+    Every page stays in memory until the file is written, so more than
+    `max_rows` invoices raise ValueError. Other arguments are as for
+    iter_invoices().
+    """
+    writer = PdfWriter()
+    invoices = 0
+
+    for invoice_nos, pdf_bytes in _iter_rendered(csv_file, progress, batch_size, workers,
+                                                 failures, chunk_rows, combined=True):
+        invoices += len(invoice_nos)
+        if max_rows and invoices > max_rows:
+            raise ValueError(_too_many_invoices(max_rows))
+        with stage("invoice", "combine_pdf"):
+            pages = PdfReader(io.BytesIO(pdf_bytes)).pages
+            # A batch has exactly one page per invoice; a lone invoice keeps all its pages
+            starts = range(len(invoice_nos)) if len(invoice_nos) > 1 else [0]
+            offset = len(writer.pages)
+            for page in pages:
+                writer.add_page(page)
+            for invoice_no, start in zip(invoice_nos, starts):
+                writer.add_outline_item(f"Invoice {invoice_no}", offset + start)
+
+    with stage("invoice", "write_pdf"):
+        if failures:
+            report = "\n".join(f"{name}: {error}" for name, error in failures)
+            writer.add_attachment("failed_invoices.txt", (report + "\n").encode("utf-8"))
+        writer.page_mode = "/UseOutlines"
+        writer.compress_identical_objects()
+        with open(output_path, "wb") as f:
+            writer.write(f)
+
+    return output_path
+
+def generate_invoices(csv_file, output_dir, progress=None, batch_size=INVOICE_BATCH_SIZE,
+                      workers=1, failures=None, chunk_rows=INVOICE_CHUNK_ROWS):
+    os.makedirs(output_dir, exist_ok=True)
 
     generated_files = []
 
-    for _, row in df.iterrows():
-        amount = row["Quantity"] * row["Rate"]
-        gst_amount = amount * row["GST_Percent"] / 100
-        total = amount + gst_amount
-
-        html = template.render(
-            invoice_no=row["Invoice_No"],
-            invoice_date=row["Invoice_Date"],
-            customer_name=row["Customer_Name"],
-            customer_address=row["Customer_Address"],
-            service_name=row["Service_Name"],
-            quantity=row["Quantity"],
-            rate=row["Rate"],
-            amount=amount,
-            gst_percent=row["GST_Percent"],
-            gst_amount=gst_amount,
-            total=total
-        )
-
-        pdf_path = os.path.join(
-            output_dir, f"invoice_{row['Invoice_No']}.pdf"
-        )
-
-        pdfkit.from_string(html, pdf_path)
+    for filename, pdf_bytes in iter_invoices(csv_file, progress=progress, batch_size=batch_size,
+                                             workers=workers, failures=failures, chunk_rows=chunk_rows):
+        pdf_path = os.path.join(output_dir, filename)
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_bytes)
         generated_files.append(pdf_path)
 
     return generated_files
@@ -0,0 +1,167 @@
+"""
+Lightweight metrics for the web app and the tools.
+
+Each process (gunicorn worker or pool worker) records counters and histograms
+in memory; flush() adds the deltas into a shared SQLite table so /metrics can
+report totals across every process. render() turns the stored totals (plus
+any gauges computed at scrape time) into Prometheus text format.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds. Goes past the usual Prometheus defaults because OCR jobs take minutes.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_help = {}
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def describe(name, text):
+    _help[name] = text
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        else:
+            hist[len(BUCKETS)] += 1
+        hist[-1] += value
+
+@contextmanager
+def timer(name, **labels):
+    """Times the enclosed block into histogram `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def stage(tool, stage_name):
+    """Shorthand for the per-stage timer shared by routes and tools."""
+    return timer("stage_duration_seconds", tool=tool, stage=stage_name)
+
+# ---------------- PERSISTENCE ----------------
+
+def init_db(conn):
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS metrics (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (name, labels, bucket)
+            ) WITHOUT ROWID
+        """)
+
+def _encode_labels(labels):
+    return ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels)
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def flush(conn):
+    """Moves this process's pending deltas into the shared table."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+        _counters.clear()
+        _histograms.clear()
+
+    rows = []
+    for (name, labels), value in counters.items():
+        rows.append((name, _encode_labels(labels), "counter", "", value))
+    for (name, labels), hist in histograms.items():
+        encoded = _encode_labels(labels)
+        for bound, count in zip(list(BUCKETS) + ["+Inf"], hist[:-1]):
+            if count:
+                rows.append((name, encoded, "histogram", str(bound), count))
+        rows.append((name, encoded, "histogram", "count", sum(hist[:-1])))
+        rows.append((name, encoded, "histogram", "sum", hist[-1]))
+
+    if not rows:
+        return
+    with conn:
+        conn.executemany(
+            "INSERT INTO metrics (name, labels, kind, bucket, value) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (name, labels, bucket) DO UPDATE SET value = value + excluded.value",
+            rows
+        )
+
+def _fmt(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+def _series(name, labels, extra=""):
+    parts = [p for p in (labels, extra) if p]
+    if parts:
+        return f"{name}{{{','.join(parts)}}}"
+    return name
+
+def render(conn, extra=()):
+    """
+    Prometheus text exposition of everything flushed so far.
+    `extra` is an iterable of (name, type, labels_dict, value) samples computed
+    by the caller at scrape time (gauges, or counters kept elsewhere).
+    """
+    counters = {}
+    histograms = {}
+    for name, labels, kind, bucket, value in conn.execute(
+        "SELECT name, labels, kind, bucket, value FROM metrics ORDER BY name, labels"
+    ):
+        if kind == "counter":
+            counters.setdefault(name, []).append((labels, value))
+        else:
+            histograms.setdefault(name, {}).setdefault(labels, {})[bucket] = value
+
+    lines = []
+    for name, series in counters.items():
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in series:
+            lines.append(f"{_series(name, labels)} {_fmt(value)}")
+
+    for name, series in histograms.items():
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, buckets in series.items():
+            cumulative = 0
+            for bound in list(BUCKETS) + ["+Inf"]:
+                cumulative += buckets.get(str(bound), 0)
+                le = 'le="%s"' % bound
+                lines.append(f"{_series(name + '_bucket', labels, le)} {_fmt(cumulative)}")
+            lines.append(f"{_series(name + '_sum', labels)} {_fmt(buckets.get('sum', 0))}")
+            lines.append(f"{_series(name + '_count', labels)} {_fmt(buckets.get('count', 0))}")
+
+    seen = set()
+    for name, kind, labels, value in extra:
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+        encoded = _encode_labels(sorted(labels.items()))
+        lines.append(f"{_series(name, encoded)} {_fmt(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,113 @@
+"""
+OCR results per page image, shared by every process.
+
+Scanned pages are keyed by a hash of their rendered pixels, so a page image
+that was OCR'd before (a letterhead repeated through a document, the same
+statement uploaded again) is answered from here instead of by Tesseract.
+Entries are the OCR'd word boxes in one SQLite file; they expire after
+OCR_CACHE_MAX_AGE and the least recently used are dropped once they pass
+OCR_CACHE_MAX_BYTES. A cache that can't be read or written is treated as
+empty: it never fails a page.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Empty disables the cache
+OCR_CACHE_PATH = os.environ.get("OCR_CACHE_PATH", os.path.join(tempfile.gettempdir(), "ocr_cache.db"))
+OCR_CACHE_MAX_BYTES = int(os.environ.get("OCR_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+OCR_CACHE_MAX_AGE = int(os.environ.get("OCR_CACHE_MAX_AGE", 24 * 60 * 60))
+
+def image_key(image, salt=""):
+    """sha256 of the image's pixels (plus `salt`, for settings that change the result)."""
+    h = hashlib.sha256()
+    h.update(f"{salt}|{image.mode}|{image.size}".encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+class OcrCache:
+    def __init__(self, path=OCR_CACHE_PATH, max_bytes=OCR_CACHE_MAX_BYTES, max_age=OCR_CACHE_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS ocr_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_hit REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_hit ON ocr_cache (last_hit)")
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                row = self._conn.execute(
+                    "SELECT value FROM ocr_cache WHERE key = ? AND created_at >= ?",
+                    (key, now - self.max_age)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._conn.execute("UPDATE ocr_cache SET last_hit = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+        except sqlite3.Error:
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        text = json.dumps(value, separators=(",", ":"))
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO ocr_cache (key, value, size, created_at, last_hit) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, text, len(text), now, now)
+                )
+                self._evict(now)
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - self.max_age,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # least recently used first, until back under the limit
+        drop = []
+        for key, size in self._conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_hit"):
+            if total <= self.max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM ocr_cache WHERE key = ?", drop)
+
+    def close(self):
+        self._conn.close()
+
+_cache = None
+_cache_pid = None
+
+def get_cache():
+    """This process's OcrCache, or None when disabled or unusable."""
+    global _cache, _cache_pid
+    if not OCR_CACHE_PATH:
+        return None
+    if _cache_pid != os.getpid():
+        # forked pool workers open their own connection
+        _cache_pid = os.getpid()
+        try:
+            _cache = OcrCache()
+        except sqlite3.Error:
+            _cache = None
+    return _cache
@@ -0,0 +1,196 @@
+"""
+Tables from OCR'd page images.
+
+Tesseract's word boxes (image_to_data) are grouped into text rows by their
+vertical centres, and each row is cut into cells wherever the gap between
+two words is wider than OCR_CELL_GAP word spaces. Consecutive
+rows with two or more cells form a table; its columns are the x-ranges
+where cells of different rows overlap, and every cell goes to the column it
+overlaps most.
+
+ocr_page() picks the resolution: a low-DPI pass first, and a high-DPI one
+only when that looks unreliable, with results cached per page image (see
+tools.ocr_cache).
+
+The older route, kept as ocr_tables_via_pdf() for comparison
+(benchmarks/ocr_tables.py), had Tesseract write a searchable PDF and read it
+back with pdfplumber, which costs a PDF serialize and parse per page.
+"""
+
+import io
+import os
+from statistics import median
+
+import pdfplumber
+import pytesseract
+
+from tools.ocr_cache import image_key
+
+# Words below this Tesseract confidence (0-100) are treated as noise
+OCR_MIN_CONFIDENCE = float(os.environ.get("OCR_MIN_CONFIDENCE", 30))
+
+# A gap this many word spaces wide separates two cells
+OCR_CELL_GAP = float(os.environ.get("OCR_CELL_GAP", 1.5))
+
+# Pages are OCR'd at OCR_LOW_DPI first and rendered again at OCR_HIGH_DPI only
+# when that pass looks unreliable: mean word confidence under
+# OCR_RETRY_CONFIDENCE, text under OCR_MIN_TEXT_PX tall (too few pixels per
+# character for Tesseract), or no words at all on a page with ink on it.
+OCR_LOW_DPI = int(os.environ.get("OCR_LOW_DPI", 150))
+OCR_HIGH_DPI = int(os.environ.get("OCR_HIGH_DPI", 300))
+OCR_RETRY_CONFIDENCE = float(os.environ.get("OCR_RETRY_CONFIDENCE", 80))
+OCR_MIN_TEXT_PX = int(os.environ.get("OCR_MIN_TEXT_PX", 14))
+
+# Share of dark pixels above which a page with no words gets the high-DPI pass
+OCR_INK_FRACTION = 0.001
+
+def ocr_words(image):
+    """Word boxes as (left, top, right, bottom, text, confidence)."""
+    data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+    words = []
+    for text, conf, left, top, width, height in zip(
+        data["text"], data["conf"], data["left"], data["top"], data["width"], data["height"]
+    ):
+        text = (text or "").strip()
+        conf = float(conf)
+        # non-word levels (blocks, lines) have conf -1 and no text
+        if text and conf >= OCR_MIN_CONFIDENCE:
+            words.append((left, top, left + width, top + height, text, conf))
+    return words
+
+def group_rows(words):
+    """Words grouped into rows (each sorted left to right), top to bottom."""
+    if not words:
+        return []
+    tolerance = median(bottom - top for _, top, _, bottom, _, _ in words) / 2
+
+    rows = []  # [sum of word centres, words]
+    for word in sorted(words, key=lambda w: (w[1] + w[3]) / 2):
+        centre = (word[1] + word[3]) / 2
+        if rows and abs(centre - rows[-1][0] / len(rows[-1][1])) <= tolerance:
+            rows[-1][0] += centre
+            rows[-1][1].append(word)
+        else:
+            rows.append([centre, [word]])
+    return [sorted(row, key=lambda w: w[0]) for _, row in rows]
+
+def split_cells(row, gap):
+    """A row's words as cells: (left, right, text)."""
+    cells = []
+    for left, _, right, _, text, _ in row:
+        if cells and left - cells[-1][1] <= gap:
+            cell_left, _, cell_text = cells[-1]
+            cells[-1] = (cell_left, right, cell_text + " " + text)
+        else:
+            cells.append((left, right, text))
+    return cells
+
+def _columns(rows):
+    """x-ranges where cells of the table's rows overlap, left to right."""
+    spans = sorted((left, right) for cells in rows for left, right, _ in cells)
+    columns = [list(spans[0])]
+    for left, right in spans[1:]:
+        if left <= columns[-1][1]:
+            columns[-1][1] = max(columns[-1][1], right)
+        else:
+            columns.append([left, right])
+    return columns
+
+def _table(rows):
+    columns = _columns(rows)
+    table = []
+    for cells in rows:
+        out = [""] * len(columns)
+        for left, right, text in cells:
+            best = max(range(len(columns)),
+                       key=lambda c: min(right, columns[c][1]) - max(left, columns[c][0]))
+            out[best] = (out[best] + " " + text).strip()
+        table.append(out)
+    return table
+
+def _word_space(rows):
+    """
+    Width of one space between words: the smaller gaps in the rows, but no
+    more than half the word height, in case every gap on the page is
+    between cells.
+    """
+    heights = [bottom - top for row in rows for _, top, _, bottom, _, _ in row]
+    gaps = sorted(b[0] - a[2] for row in rows for a, b in zip(row, row[1:]) if b[0] > a[2])
+    space = median(heights) / 2
+    if gaps:
+        space = min(space, gaps[len(gaps) // 5])
+    return space
+
+def words_to_tables(words):
+    """Returns (tables as lists of rows, page text) for one page of word boxes."""
+    rows = group_rows(words)
+    if not rows:
+        return [], ""
+
+    gap = OCR_CELL_GAP * _word_space(rows)
+
+    tables = []
+    run = []
+    for row in rows + [[]]:
+        cells = split_cells(row, gap)
+        if len(cells) >= 2:
+            run.append(cells)
+            continue
+        # a row of 0-1 cells (title, paragraph, end of page) ends the table
+        if len(run) >= 2:
+            tables.append(_table(run))
+        run = []
+
+    text = "\n".join(" ".join(w[4] for w in row) for row in rows)
+    return tables, text
+
+def ocr_tables(image):
+    """OCRs a page image. Returns (tables as lists of rows, page text)."""
+    return words_to_tables(ocr_words(image))
+
+def _has_ink(image):
+    histogram = image.histogram()
+    return sum(histogram[:128]) > OCR_INK_FRACTION * sum(histogram)
+
+def _needs_high_dpi(words, image):
+    if not words:
+        return _has_ink(image)
+    confidence = sum(w[5] for w in words) / len(words)
+    height = median(w[3] - w[1] for w in words)
+    return confidence < OCR_RETRY_CONFIDENCE or height < OCR_MIN_TEXT_PX
+
+def _cache_salt():
+    """Everything besides the pixels that changes which words come out."""
+    return (f"{pytesseract.get_tesseract_version()}|{OCR_LOW_DPI}|{OCR_HIGH_DPI}|"
+            f"{OCR_RETRY_CONFIDENCE}|{OCR_MIN_TEXT_PX}|{OCR_MIN_CONFIDENCE}")
+
+def ocr_page(render, cache=None):
+    """
+    OCRs one page at the lowest resolution that reads well. `render(dpi)`
+    returns the page as a PIL image; `cache` is an OcrCache or None.
+    Returns (tables, page text, {"dpi": resolution used, "cached": bool}).
+    """
+    image = render(OCR_LOW_DPI).convert("L")
+    key = image_key(image, _cache_salt())
+    hit = cache.get(key) if cache else None
+    if hit is not None:
+        tables, text = words_to_tables([tuple(word) for word in hit["words"]])
+        return tables, text, {"dpi": hit["dpi"], "cached": True}
+
+    dpi = OCR_LOW_DPI
+    words = ocr_words(image)
+    if OCR_HIGH_DPI > OCR_LOW_DPI and _needs_high_dpi(words, image):
+        dpi = OCR_HIGH_DPI
+        words = ocr_words(render(OCR_HIGH_DPI).convert("L"))
+
+    if cache:
+        cache.put(key, {"dpi": dpi, "words": words})
+    tables, text = words_to_tables(words)
+    return tables, text, {"dpi": dpi, "cached": False}
+
+def ocr_tables_via_pdf(image):
+    """The old route through a searchable PDF; same return value as ocr_tables()."""
+    pdf_bytes = pytesseract.image_to_pdf_or_hocr(image, extension='pdf')
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as ocr_pdf:
+        ocr_page = ocr_pdf.pages[0]
+        return ocr_page.extract_tables(), ocr_page.extract_text() or ""
@@ -1,31 +1,49 @@
 import os
+import io
 from pypdf import PdfReader, PdfWriter
+from tools.metrics import stage
 
-def merge_pdfs(input_paths, output_path):
+# Inputs may be paths or binary file-like objects.
+
+def merge_pdfs(input_files, output_path, progress=None):
     writer = PdfWriter()
-    for path in input_paths:
-        reader = PdfReader(path)
-        for page in reader.pages:
-            writer.add_page(page)
+    for i, input_file in enumerate(input_files):
+        with stage("pdf_merge", "read_pdf"):
+            reader = PdfReader(input_file)
+            for page in reader.pages:
+                writer.add_page(page)
+        if progress:
+            progress(i + 1, len(input_files))
     
-    with open(output_path, "wb") as f:
+    with stage("pdf_merge", "write_pdf"), open(output_path, "wb") as f:
         writer.write(f)
     return output_path
 
-def split_pdf(input_path, output_dir):
+def iter_split_pdf(input_file, progress=None):
+    """Yields (filename, pdf_bytes) for each page, without touching disk."""
+    reader = PdfReader(input_file)
+    total_pages = len(reader.pages)
+
+    for i, page in enumerate(reader.pages):
+        with stage("pdf_split", "split_page"):
+            writer = PdfWriter()
+            writer.add_page(page)
+
+            buffer = io.BytesIO()
+            writer.write(buffer)
+        yield f"page_{i+1}.pdf", buffer.getvalue()
+
+        if progress:
+            progress(i + 1, total_pages)
+
+def split_pdf(input_file, output_dir, progress=None):
     os.makedirs(output_dir, exist_ok=True)
-    reader = PdfReader(input_path)
     split_files = []
-    
-    for i, page in enumerate(reader.pages):
-        writer = PdfWriter()
-        writer.add_page(page)
-        
-        output_filename = f"page_{i+1}.pdf"
-        output_path = os.path.join(output_dir, output_filename)
-        
+
+    for filename, pdf_bytes in iter_split_pdf(input_file, progress=progress):
+        output_path = os.path.join(output_dir, filename)
         with open(output_path, "wb") as f:
-            writer.write(f)
+            f.write(pdf_bytes)
         split_files.append(output_path)
-        
+
     return split_files
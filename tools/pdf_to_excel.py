@@ -1,117 +1,343 @@
 import pdfplumber
 import pandas as pd
 import os
-import pytesseract
-from PIL import Image
 import io
-from pypdf import PdfReader, PdfWriter
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+from openpyxl import Workbook
+from tools import metrics
+from tools.metrics import stage
+from tools.ocr_cache import get_cache
+from tools.ocr_tables import ocr_page, ocr_tables_via_pdf
+from tools.streaming import imap_ordered
+from tools.table_output import KIND_PATTERNS, XLSX_ILLEGAL_CHARS, convert_column
 
-def pdf_to_excel(pdf_path, output_dir):
+# A column becomes numbers when every cell matches one of these (see
+# tools.table_output); empty cells are allowed in float columns only.
+INT_PATTERN = dict(KIND_PATTERNS)["int"]
+NUMBER_PATTERN = dict(KIND_PATTERNS)["float"]
+
+# Processes used by parallel mode (workers > 1). Each opens the PDF once and
+# takes pages one at a time; results are put back in page order.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+
+# Shorter documents are done in-process: pool startup and a second parse of
+# the PDF per worker cost more than a few pages save.
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 4))
+
+# How scanned pages become tables: "words" rebuilds them from Tesseract's word
+# boxes, "pdf" is the old round trip through a searchable PDF (see tools.ocr_tables)
+OCR_TABLE_MODE = os.environ.get("OCR_TABLE_MODE", "words")
+
+# Page classification (classify_page). A page needs OCR when fewer than
+# PAGE_MIN_CHARS characters are drawn on it as text, or when an image
+# covering PAGE_SCAN_COVERAGE of the page has fewer than that on top of it
+# (a scan with only a printed header or footer). A page with little text and
+# nothing else drawn on it gains nothing from OCR.
+PAGE_MIN_CHARS = int(os.environ.get("PAGE_MIN_CHARS", 50))
+PAGE_SCAN_COVERAGE = float(os.environ.get("PAGE_SCAN_COVERAGE", 0.5))
+
+def _inside(obj, box):
+    x = (obj["x0"] + obj["x1"]) / 2
+    y = (obj["top"] + obj["bottom"]) / 2
+    return box["x0"] <= x <= box["x1"] and box["top"] <= y <= box["bottom"]
+
+def classify_page(page):
+    """
+    "text", "scanned" or "blank", from the page's parsed objects alone
+    (character count, image coverage, vector drawing) without laying out
+    any text. The objects are parsed once and reused by text and table
+    extraction.
+    """
+    chars = page.chars
+    images = page.images
+    page_area = float(page.width * page.height) or 1.0
+
+    large_images = [
+        image for image in images
+        if (image["x1"] - image["x0"]) * (image["bottom"] - image["top"]) >= PAGE_SCAN_COVERAGE * page_area
+    ]
+    for image in large_images:
+        # a text layer over a scan (already OCR'd) has its characters on the image
+        if sum(_inside(char, image) for char in chars) < PAGE_MIN_CHARS:
+            return "scanned"
+
+    if len(chars) >= PAGE_MIN_CHARS:
+        return "text"
+    if images or page.curves:
+        # glyphs drawn as images or outlines
+        return "scanned"
+    return "text" if chars else "blank"
+
+def extract_page(page, number):
+    """
+    Returns (tables, text lines, {stage: seconds}, info) for one page.
+    Tables are lists of rows with None cells as ""; text lines are only
+    filled when the page has no tables. info has the page kind (see
+    classify_page), for OCR'd pages the DPI used and whether the OCR cache
+    answered, and "error" if OCR failed. Runs in pool workers too, so
+    timings and info are handed back for the caller to record (see
+    record_page).
+    """
+    timings = {}
+
+    # 1. Decide the path from the page's objects, before laying out any text
+    start = time.perf_counter()
+    kind = classify_page(page)
+    timings["classify"] = time.perf_counter() - start
+    info = {"kind": kind}
+
+    tables = []
+    raw_text = ""
+
+    if kind == "scanned":
+        ocr_start = time.perf_counter()
+        try:
+            # Rows and columns straight from Tesseract's word boxes, at the
+            # lowest resolution that reads well and cached per page image (see
+            # tools.ocr_tables). OCR_TABLE_MODE "pdf" is the old 300 DPI round
+            # trip through a searchable PDF.
+            if OCR_TABLE_MODE == "pdf":
+                tables, raw_text = ocr_tables_via_pdf(page.to_image(resolution=300).original)
+                info.update(dpi=300, cached=False)
+            else:
+                tables, raw_text, ocr = ocr_page(lambda dpi: page.to_image(resolution=dpi).original,
+                                                 get_cache())
+                info.update(ocr)
+
+        except Exception as e:
+            # If OCR fails, we just proceed with what we have (fail safe)
+            print(f"OCR warning on page {number}: {e}")
+            info["error"] = str(e) or type(e).__name__
+        timings["ocr_page"] = time.perf_counter() - ocr_start
+
+    elif kind == "text":
+        # Standard text PDF
+        start = time.perf_counter()
+        tables = page.extract_tables()
+        timings["extract_tables"] = time.perf_counter() - start
+
+    if not tables and not raw_text.strip() and page.chars:
+        # Text is only laid out when it's the fallback: no tables, and no OCR text
+        start = time.perf_counter()
+        raw_text = page.extract_text() or ""
+        timings["extract_text"] = time.perf_counter() - start
+
+    # 2. Keep tables with a header row and at least one data row
+    cleaned_tables = []
+    for table in tables:
+        # table is usually a list of lists
+        if table and len(table) > 1:
+            # Basic cleanup: remove none values
+            cleaned_table = [[cell if cell is not None else "" for cell in row] for row in table]
+
+            # Heuristic: headers are usually the first row
+            # Check if we have enough columns
+            if len(cleaned_table[0]) > 0:
+                cleaned_tables.append(cleaned_table)
+
+    text_lines = []
+    if not tables:
+        # If no tables found, use the raw text as fallback rows
+        # Split by newline
+        text_lines = [line.strip() for line in raw_text.split('\n') if line.strip()]
+
+    return cleaned_tables, text_lines, timings, info
+
+def record_page(timings, info):
+    for stage_name, seconds in timings.items():
+        metrics.observe("stage_duration_seconds", seconds, tool="pdf_to_excel", stage=stage_name)
+    metrics.inc("pdf_pages_total", kind=info["kind"])
+    if "ocr_page" in timings:
+        metrics.inc("ocr_pages_total")
+    if "dpi" in info:
+        metrics.inc("ocr_cache_lookups_total", result="hit" if info["cached"] else "miss")
+        metrics.inc("ocr_page_dpi_total", dpi=info["dpi"])
+
+# ---------------- PARALLEL ----------------
+
+_worker_pdf = None
+
+def _open_worker_pdf(source):
+    """Pool initializer: every worker parses the PDF once, into its own handle."""
+    global _worker_pdf
+    _worker_pdf = pdfplumber.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+
+def _extract_worker_page(index):
+    page = _worker_pdf.pages[index]
+    try:
+        return extract_page(page, index + 1)
+    finally:
+        # drop the page's cached layout objects; the handle lives on
+        page.close()
+
+def _extract_parallel(source, total_pages, workers):
+    """Yields extract_page() results in page order (see tools.streaming.imap_ordered)."""
+    return imap_ordered(_extract_worker_page, ((index,) for index in range(total_pages)), workers,
+                        initializer=_open_worker_pdf, initargs=(source,))
+
+def _extract_sequential(pdf):
+    for i, page in enumerate(pdf.pages):
+        try:
+            yield extract_page(page, i + 1)
+        finally:
+            page.close()
+
+def _worker_source(pdf_file):
+    """What pool workers open: the path, or the whole file as bytes."""
+    if isinstance(pdf_file, (str, os.PathLike)):
+        return pdf_file
+    pdf_file.seek(0)
+    return pdf_file.read()
+
+# ---------------- WRITE ----------------
+
+def _xlsx_strings(values):
+    """Values as text Excel accepts (control characters dropped)."""
+    cells = pa.array([str(value) for value in values], type=pa.large_string())
+    return pc.replace_substring_regex(cells, XLSX_ILLEGAL_CHARS, "").to_pylist()
+
+def table_columns(table):
+    """
+    A table's body as one list of values per column, numbers where a whole
+    column is numeric. The cells are matched in one pass per table: they are
+    laid out column after column in a single Arrow array, so each column is
+    a slice of it.
+    """
+    header, body = table[0], table[1:]
+    width, height = len(header), len(body)
+    # OCR'd rows can come up short
+    body = [list(row[:width]) + [""] * (width - len(row)) for row in body]
+
+    cells = pa.array([str(row[c]) for c in range(width) for row in body], type=pa.large_string())
+    cells = pc.replace_substring_regex(cells, XLSX_ILLEGAL_CHARS, "")
+    trimmed = pc.utf8_trim_whitespace(cells)
+    empty = pc.equal(trimmed, "")
+
+    def by_column(mask):
+        return mask.to_numpy(zero_copy_only=False).reshape(width, height)
+
+    empty_grid = by_column(empty)
+    is_int = by_column(pc.match_substring_regex(trimmed, INT_PATTERN)).all(axis=1)
+    is_number = (by_column(pc.match_substring_regex(trimmed, NUMBER_PATTERN)) | empty_grid).all(axis=1)
+    is_number &= ~empty_grid.all(axis=1)
+
+    columns = []
+    for c in range(width):
+        column = slice(c * height, (c + 1) * height)
+        if is_int[c]:
+            values = convert_column(trimmed[column], pa.int64())
+        elif is_number[c]:
+            values = pc.cast(pc.if_else(empty[column], None, trimmed[column]), pa.float64())
+        else:
+            values = cells[column]
+        columns.append(values.to_pylist())
+    return columns
+
+class TableBook:
+    """
+    The output workbook, written as tables arrive: each table goes straight
+    to its own write-only sheet (Table_1, Table_2, ...), which openpyxl keeps
+    in a temporary file rather than in memory until save().
+    """
+
+    def __init__(self):
+        self._wb = Workbook(write_only=True)
+        self.tables = 0
+
+    def add_table(self, table):
+        self.tables += 1
+        ws = self._wb.create_sheet(f"Table_{self.tables}")
+        ws.append(_xlsx_strings(table[0]))
+        for row in zip(*table_columns(table)):
+            ws.append(row)
+
+    def add_text(self, lines):
+        """The fallback sheet for documents without tables: one line per row."""
+        ws = self._wb.create_sheet("Sheet1")
+        for line in _xlsx_strings(lines):
+            ws.append([line])
+
+    def save(self, path):
+        self._wb.save(path)
+
+# ---------------- CONVERT ----------------
+
+def pdf_to_excel(pdf_file, output_dir, progress=None, workers=1, failures=None):
     """
     Converts a PDF (text-based or scanned) to an Excel file.
     Uses OCR if text extraction fails or yields too little text.
+    `pdf_file` may be a path or a binary file-like object.
+    `progress(done, total)` is called after each page, if given.
+
+    With workers > 1, documents of PDF_PARALLEL_MIN_PAGES or more are
+    extracted across a process pool, one page per task; the output is the same.
+
+    Tables are written to the workbook page by page (see TableBook), so
+    memory doesn't grow with the number of tables in the document.
+
+    Failures never raise: pages that couldn't be OCR'd are left out, and if
+    the document can't be read at all the workbook just says so. If
+    `failures` is a list, each of these is appended to it as (where, error).
     """
     os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, "output.xlsx")
-    
-    all_tables = []
+
+    book = TableBook()
+    # Only written when the document turns out to have no tables at all
     text_rows = []
 
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                # 1. Try extracting text first
-                raw_text = page.extract_text() or ""
-                clean_text = raw_text.strip()
-
-                tables = []
-                
-                # If page appears to be scanned (little to no text), try OCR
-                # Threshold: less than 50 characters might suggest a scanned page (mostly empty or image)
-                # or just garbage.
-                if len(clean_text) < 50:
-                    try:
-                        # Convert page to image
-                        # resolution=300 is standard for OCR
-                        img_obj = page.to_image(resolution=300)
-                        pil_image = img_obj.original
-                        
-                        # Use pytesseract to get a searchable PDF overlay or just data
-                        # To extract TABLES, it's best to let pdfplumber handle a searchable PDF.
-                        # So we convert the image to a searchable PDF using Tesseract.
-                        pdf_bytes = pytesseract.image_to_pdf_or_hocr(pil_image, extension='pdf')
-                        
-                        # Open the OCR'd PDF page with pdfplumber
-                        with pdfplumber.open(io.BytesIO(pdf_bytes)) as ocr_pdf:
-                            ocr_page = ocr_pdf.pages[0]
-                            tables = ocr_page.extract_tables()
-                            # verification: did we get better text?
-                            ocr_text = ocr_page.extract_text() or ""
-                            if not clean_text and ocr_text:
-                                raw_text = ocr_text # Use OCR text for fallback
-                                
-                    except Exception as e:
-                        # If OCR fails, we just proceed with what we have (fail safe)
-                        print(f"OCR warning on page {i+1}: {e}")
-                        pass
-                else:
-                    # Standard text PDF
-                    tables = page.extract_tables()
-
-                # 2. Process Tables
-                if tables:
-                    for table in tables:
-                        # table is usually a list of lists
-                        if table and len(table) > 1:
-                            # Basic cleanup: remove none values
-                            cleaned_table = [[cell if cell is not None else "" for cell in row] for row in table]
-                            
-                            # Heuristic: headers are usually the first row
-                            # Check if we have enough columns
-                            if len(cleaned_table[0]) > 0:
-                                df = pd.DataFrame(cleaned_table[1:], columns=cleaned_table[0])
-                                # Attempt numeric conversion
-                                for col in df.columns:
-                                    df[col] = pd.to_numeric(df[col], errors='ignore')
-                                all_tables.append(df)
-                else:
-                    # If no tables found, use the raw text as fallback rows
-                    # Split by newline
-                    lines = raw_text.split('\n')
-                    for line in lines:
-                        if line.strip():
-                            text_rows.append([line.strip()])
-
-        # 3. Compile Output
-        if not all_tables and not text_rows:
+        with pdfplumber.open(pdf_file) as pdf:
+            total_pages = len(pdf.pages)
+            if workers > 1 and total_pages >= PDF_PARALLEL_MIN_PAGES:
+                pages = _extract_parallel(_worker_source(pdf_file), total_pages, workers)
+            else:
+                pages = _extract_sequential(pdf)
+
+            try:
+                for i, (tables, text_lines, timings, info) in enumerate(pages):
+                    record_page(timings, info)
+                    if "error" in info and failures is not None:
+                        failures.append((f"page {i + 1}", info["error"]))
+
+                    # 3. Each table goes to its own sheet as soon as its page is done
+                    for cleaned_table in tables:
+                        with stage("pdf_to_excel", "write_sheet"):
+                            book.add_table(cleaned_table)
+                    if book.tables:
+                        text_rows = []
+                    else:
+                        text_rows.extend(text_lines)
+
+                    if progress:
+                        progress(i + 1, total_pages)
+            finally:
+                # shuts the pool down if a page failed
+                pages.close()
+
+        # 4. Compile Output
+        if not book.tables and not text_rows:
             # Absolute worst case: empty file or total failure
             # Create a dummy dataframe so we return a valid Excel
             df = pd.DataFrame(["No extractable text or tables found."], columns=["Status"])
             df.to_excel(output_path, index=False)
             return output_path
 
-        mode = "w"
-        if all_tables:
-            # Write tables to sheets
-            # For simplicity in this version, we concatenate into one big sheet or 
-            # if user wants separate sheets, we could use pd.ExcelWriter.
-            # User request: "If tables are detected -> convert each table to a sheet"
-            # But "If no clear table -> place extracted text row-wise in Sheet1"
-            
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                for idx, df in enumerate(all_tables):
-                    sheet_name = f"Table_{idx+1}"
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-        else:
-            # Fallback to text rows
-            df = pd.DataFrame(text_rows, columns=["Extracted Text"])
-            df.to_excel(output_path, index=False, header=False)
+        if not book.tables:
+            # If no clear table -> place extracted text row-wise in Sheet1
+            book.add_text(text_rows)
+        with stage("pdf_to_excel", "write_xlsx"):
+            book.save(output_path)
 
     except Exception as e:
         # GLOBAL FAILSAFE
         # Create a minimal Excel with the error (or just generic text) to ensure return
         print(f"Critical PDF processing error: {e}")
+        if failures is not None:
+            failures.append(("document", str(e) or type(e).__name__))
         df = pd.DataFrame(["Error processing file. Content may be corrupted or unreadable."], columns=["Error"])
         df.to_excel(output_path, index=False)
-    
+
     return output_path
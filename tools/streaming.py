@@ -0,0 +1,39 @@
+"""
+Helpers shared by the tools that stream their input: opening an upload
+(path or file object) for reading in pieces, and spreading those pieces over
+a process pool while keeping results in input order.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+def open_binary(source):
+    """Returns (binary handle, size in bytes or None, whether we opened it)."""
+    if isinstance(source, (str, os.PathLike)):
+        handle = open(source, "rb")
+        return handle, os.fstat(handle.fileno()).st_size, True
+
+    size = None
+    if source.seekable():
+        pos = source.tell()
+        size = source.seek(0, os.SEEK_END)
+        source.seek(pos)
+    return source, size, False
+
+def imap_ordered(fn, args_iter, workers, initializer=None, initargs=()):
+    """
+    Yields fn(*args) for each tuple from `args_iter`, in order, computed across
+    a pool of `workers` processes. At most 2 calls per worker are in flight, so
+    a lazy `args_iter` is only read as fast as results are taken. Closing the
+    generator shuts the pool down.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        pending = deque()
+        for args in args_iter:
+            pending.append(pool.submit(fn, *args))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
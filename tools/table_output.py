@@ -0,0 +1,217 @@
+"""
+Writers for cleaned tables: CSV (plain, gzip or zstd), Parquet and XLSX.
+
+Tables arrive as text chunks and are written as they come. CSV has no types,
+so it is written exactly as cleaned. Parquet and XLSX are typed: their
+chunks are spooled to a temporary Arrow stream while every column is
+narrowed to the most specific kind all of its values fit (see KIND_PATTERNS),
+and close() writes the file with each column converted to that format's
+type for its kind.
+"""
+
+import io
+import tempfile
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+
+# format name -> file extension
+OUTPUT_FORMATS = {
+    "csv": ".csv",
+    "csv.gz": ".csv.gz",
+    "csv.zst": ".csv.zst",
+    "parquet": ".parquet",
+    "xlsx": ".xlsx",
+}
+
+# Tried in order; a column gets the first kind that every non-empty value
+# matches. Numbers with leading zeros (codes, phone numbers) stay strings.
+KIND_PATTERNS = [
+    # Excel keeps 15 significant digits, so longer integers are "bigint"
+    ("int", r"^[+-]?(?:0|[1-9][0-9]{0,14})$"),
+    ("bigint", r"^[+-]?(?:0|[1-9][0-9]{0,17})$"),
+    ("float", r"^[+-]?(?:(?:0|[1-9][0-9]*)(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?$"),
+    ("bool", r"(?i)^(?:true|false)$"),
+    ("date", r"^[0-9]{4}-[0-9]{2}-[0-9]{2}$"),
+]
+
+# Kinds that can share a column, and the kind the column becomes
+WIDER_KIND = {
+    frozenset(["int", "bigint"]): "bigint",
+    frozenset(["int", "float"]): "float",
+}
+
+# kind -> Arrow type, per typed format. Missing kinds stay strings.
+PARQUET_TYPES = {
+    "int": pa.int64(),
+    "bigint": pa.int64(),
+    "float": pa.float64(),
+    "bool": pa.bool_(),
+    "date": pa.date32(),
+}
+XLSX_TYPES = {
+    "int": pa.int64(),
+    "float": pa.float64(),
+    "bool": pa.bool_(),
+    "date": pa.date32(),
+}
+
+XLSX_MAX_ROWS = 1048576
+
+# Control characters Excel refuses in cell text
+XLSX_ILLEGAL_CHARS = r"[\x00-\x08\x0B\x0C\x0E-\x1F]"
+
+def column_kind(values):
+    """Kind of one Arrow string column, or None if it has no values."""
+    values = values.drop_null()
+    if len(values) == 0:
+        return None
+    for kind, pattern in KIND_PATTERNS:
+        if pc.all(pc.match_substring_regex(values, pattern)).as_py():
+            if kind == "date":
+                try:
+                    pc.cast(values, pa.date32())
+                except pa.ArrowInvalid:
+                    # right shape, impossible date (e.g. 2023-02-30)
+                    return "string"
+            return kind
+    return "string"
+
+def merge_kinds(a, b):
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    return WIDER_KIND.get(frozenset([a, b]), "string")
+
+def convert_column(values, arrow_type):
+    """Casts an Arrow string column (already checked to fit) to `arrow_type`."""
+    if pa.types.is_integer(arrow_type):
+        # Arrow's integer parser doesn't take a leading "+"
+        values = pc.replace_substring_regex(values, r"^\+", "")
+    elif pa.types.is_boolean(arrow_type):
+        values = pc.utf8_lower(values)
+    return pc.cast(values, arrow_type)
+
+class CsvWriter:
+    def __init__(self, path, compression=None):
+        raw = pa.CompressedOutputStream(path, compression) if compression else open(path, "wb")
+        self._out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        self._header = True
+
+    def write(self, df):
+        df.to_csv(self._out, index=False, header=self._header)
+        self._header = False
+
+    def write_text(self, text):
+        """Rows already rendered as CSV (after a write() that put out the header)."""
+        self._out.write(text)
+
+    def close(self):
+        self._out.close()
+
+    def abort(self):
+        """Stops writing; the partial file is left for the caller to replace or remove."""
+        self._out.close()
+
+class TypedWriter:
+    """Parquet or XLSX; see the module docstring."""
+
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        self.rows = 0
+        self._spool = tempfile.TemporaryFile(prefix="typed_")
+        self._stream = None
+        self._schema = None
+        self._kinds = None
+
+    def write(self, df):
+        if self._schema is None:
+            self._schema = pa.schema([(str(name), pa.large_string()) for name in df.columns])
+            self._kinds = [None] * len(self._schema)
+            self._stream = pa.ipc.new_stream(self._spool, self._schema)
+
+        self.rows += len(df)
+        if self.output_format == "xlsx" and self.rows >= XLSX_MAX_ROWS:
+            raise ValueError(f"Too many rows for XLSX (Excel's limit is {XLSX_MAX_ROWS - 1:,}); "
+                             "choose CSV or Parquet instead")
+
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(df[col], type=pa.large_string(), from_pandas=True) for col in df.columns],
+            schema=self._schema,
+        )
+        for i, column in enumerate(batch.columns):
+            if self._kinds[i] != "string":
+                self._kinds[i] = merge_kinds(self._kinds[i], column_kind(column))
+        self._stream.write_batch(batch)
+
+    def close(self):
+        try:
+            if self._stream is None:
+                return
+            self._stream.close()
+            self._spool.seek(0)
+            batches = pa.ipc.open_stream(self._spool)
+            if self.output_format == "parquet":
+                self._write_parquet(batches)
+            else:
+                self._write_xlsx(batches)
+        finally:
+            self._spool.close()
+
+    def abort(self):
+        """Drops everything written so far without writing the file."""
+        if self._stream is not None:
+            self._stream.close()
+        self._spool.close()
+
+    def _typed(self, batches, types):
+        schema = pa.schema([
+            (field.name, types.get(kind, pa.large_string()))
+            for field, kind in zip(self._schema, self._kinds)
+        ])
+        for batch in batches:
+            columns = [
+                column if field.type == pa.large_string() else convert_column(column, field.type)
+                for column, field in zip(batch.columns, schema)
+            ]
+            yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+    def _write_parquet(self, batches):
+        writer = None
+        try:
+            for batch in self._typed(batches, PARQUET_TYPES):
+                if writer is None:
+                    writer = pq.ParquetWriter(self.path, batch.schema, compression="zstd")
+                writer.write_batch(batch)
+            if writer is None:
+                writer = pq.ParquetWriter(self.path, self._schema, compression="zstd")
+        finally:
+            if writer:
+                writer.close()
+
+    def _write_xlsx(self, batches):
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Cleaned")
+        ws.append(self._schema.names)
+        for batch in self._typed(batches, XLSX_TYPES):
+            columns = []
+            for column in batch.columns:
+                if column.type == pa.large_string():
+                    column = pc.replace_substring_regex(column, XLSX_ILLEGAL_CHARS, "")
+                columns.append(column.to_pylist())
+            for row in zip(*columns):
+                ws.append(row)
+        wb.save(self.path)
+
+def open_writer(path, output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format == "csv":
+        return CsvWriter(path)
+    if output_format.startswith("csv."):
+        return CsvWriter(path, {"gz": "gzip", "zst": "zstd"}[output_format[4:]])
+    return TypedWriter(path, output_format)